@@ -14,15 +14,21 @@ Output: trainer_output.sqlite с таблицами:
   - run_meta, games, moves, drills
 """
 
-import argparse, io, os, re, sys, time, json, sqlite3, math, asyncio
+import argparse, contextlib, functools, io, os, re, sys, time, json, sqlite3, math, asyncio, queue, threading
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Dict, Optional, Tuple
+from hashlib import blake2b
+from typing import Iterable, Iterator, List, Dict, Optional, Tuple
 from pathlib import Path
 
 import requests
+from requests.adapters import HTTPAdapter
 import chess
 import chess.pgn
 import chess.engine
+import chess.polyglot
 import chess.svg
 
 try:
@@ -40,6 +46,13 @@ except ImportError:
     TELEGRAM_AVAILABLE = False
     print("[WARN] Telegram dependencies not available. Only trainer mode will work.")
 
+# aiohttp для параллельной загрузки архивов (опционально)
+try:
+    import aiohttp
+    AIOHTTP_AVAILABLE = True
+except ImportError:
+    AIOHTTP_AVAILABLE = False
+
 # Cairosvg for better board rendering (опционально)
 try:
     import cairosvg
@@ -47,14 +60,35 @@ try:
 except ImportError:
     CAIROSVG_AVAILABLE = False
 
+# TTL-кэш для сессий пользователей (опционально)
+try:
+    from cachetools import TTLCache
+    CACHETOOLS_AVAILABLE = True
+except ImportError:
+    CACHETOOLS_AVAILABLE = False
+
+# uvloop как цикл событий бота (опционально, только Unix)
+try:
+    import uvloop
+    UVLOOP_AVAILABLE = True
+except ImportError:
+    UVLOOP_AVAILABLE = False
+
 # ---------- TRAINER CONSTANTS ----------
 DEFAULT_USERNAME = "daonin"
 DEFAULT_MONTHS_BACK = 2
 DEFAULT_ONLY_5PLUS0 = True
 
+FIVE_PLUS_ZERO_TC = ("300", "300+0")
+
+USER_AGENT = "chess-personal-trainer (contact: chess-trainer@example.com)"
+ARCHIVE_FETCH_CONCURRENCY = 4
+
 ENGINE_DEPTH = 10
 ENGINE_MOVETIME = 0.0
 MAX_EVAL_POSITIONS = 2500
+# Однопоточных движков в пуле тренера: партии анализируются параллельно
+TRAINER_ENGINES = max(1, (os.cpu_count() or 2) // 2)
 
 LONG_THINK_SEC = 20
 FAST_MOVE_SEC = 5
@@ -65,21 +99,35 @@ SEVERE_BLUNDER_CP = 300
 OPENING_PLY = 14
 MIDDLEGAME_PLY = 50
 
-CLK_RE = re.compile(r"\[%clk\s+([0-9:]+)\]")
+# секунды бывают с десятыми: [%clk 0:04:58.1]
+CLK_RE = re.compile(r"\[%clk\s+(?:(\d+):)?(\d+):(\d+(?:\.\d+)?)\]")
 
 # ---------- BOT CONSTANTS ----------
 BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', '')
 STOCKFISH_PATH = os.getenv('STOCKFISH_PATH', '/opt/homebrew/bin/stockfish')
 DB_PATH = os.getenv('CHESS_DB_PATH', '/data/trainer_output.sqlite')  # Docker volume path
-
+# Движков в пуле бота: партии при /update анализируются параллельно
+ENGINE_POOL_SIZE = max(1, int(os.getenv('ENGINE_POOL_SIZE', str(TRAINER_ENGINES))))
+# Отдельный движок для проверки ответов в дриллах: оценка грубая, глубины 12 хватает
+GRADER_DEPTH = 12
+GRADER_HASH_MB = 16
+# Позиций в кэше оценок (~250 байт на запись в памяти); при переполнении вытесняются самые старые,
+# таблица eval_cache обрезается до того же размера. В контейнере с 512 МБ задается меньше
+EVAL_CACHE_SIZE = max(1, int(os.getenv('EVAL_CACHE_SIZE', '200000')))
+
+# Брошенные задачи живут в user_sessions не дольше часа
+SESSION_CACHE_SIZE = 50_000
+SESSION_TTL_SEC = 3600
 BOARD_SIZE = 400
+BOARD_PNG_CACHE_SIZE = 4096  # ~8 КБ на PNG, ≈32 МБ на весь кэш
+# Процессы для рендера: cairosvg занимает CPU и не должен блокировать event loop.
+# Каждый spawn-процесс заново импортирует модуль (~60 МБ), поэтому по умолчанию один;
+# 0 — рендер в потоке event loop'а без отдельных процессов (для контейнера с 512 МБ)
+RENDER_WORKERS = max(0, int(os.getenv('RENDER_WORKERS', '1')))
 ACCEPTABLE_CP_LOSS = 50
 
 # ---------- DATABASE SCHEMA ----------
 SCHEMA_SQL = """
-PRAGMA journal_mode=WAL;
-PRAGMA synchronous=NORMAL;
-
 CREATE TABLE IF NOT EXISTS run_meta (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   generated_at TEXT NOT NULL,
@@ -110,17 +158,13 @@ CREATE TABLE IF NOT EXISTS moves (
   side TEXT,
   phase TEXT,
   san TEXT,
-  fen_before TEXT,
+  fen_id INTEGER,  -- fens.fen_id позиции до хода
   clock_after_sec INTEGER,
   time_spent_sec INTEGER,
   eval_before_cp INTEGER,
   eval_after_cp INTEGER,
   cp_loss INTEGER,
-  is_check INTEGER,
-  is_capture INTEGER,
-  is_pawn_push INTEGER,
-  is_promotion INTEGER,
-  is_castle INTEGER,
+  flags INTEGER,  -- биты FLAG_* (шах, взятие, ход пешкой, превращение, рокировка)
   FOREIGN KEY (run_id) REFERENCES run_meta(id),
   FOREIGN KEY (game_id) REFERENCES games(game_id)
 );
@@ -141,6 +185,7 @@ CREATE TABLE IF NOT EXISTS drills (
   eval_before_cp INTEGER,
   eval_after_cp INTEGER,
   pv_best TEXT,
+  pv_best_preview TEXT,  -- первые PV_SAN_PREFIX ходов варианта через пробел, NULL если ход один
   severity INTEGER,
   tags TEXT,
   difficulty TEXT,
@@ -149,31 +194,126 @@ CREATE TABLE IF NOT EXISTS drills (
   FOREIGN KEY (game_id) REFERENCES games(game_id)
 );
 
+-- Позиции ходов без дублей: zobrist-ключ (знаковый 64 бит) -> первые четыре поля FEN
+-- (расстановка, очередь, рокировки, en passant); счетчики ходов в ключ не входят, поэтому не хранятся
+CREATE TABLE IF NOT EXISTS fens (
+  fen_id INTEGER PRIMARY KEY,
+  fen TEXT NOT NULL
+);
+
+-- Кэш оценок бота: zobrist-ключ позиции (знаковый 64 бит) + глубина -> оценка и PV в UCI;
+-- seq — порядок добавления (rowid у WITHOUT ROWID нет), по нему грузятся свежие и обрезаются старые.
+-- Индекс по seq создает migrate_schema: в старых базах колонки еще нет
+CREATE TABLE IF NOT EXISTS eval_cache (
+  zkey INTEGER NOT NULL,
+  depth INTEGER NOT NULL,
+  score_cp INTEGER NOT NULL,
+  pv TEXT NOT NULL,
+  seq INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (zkey, depth)
+) WITHOUT ROWID;
+
+-- Агрегаты дриллов по прогону для /stats
+CREATE TABLE IF NOT EXISTS run_stats (
+  run_id INTEGER PRIMARY KEY,
+  total INTEGER NOT NULL,
+  avg_cp_loss REAL,
+  sev3 INTEGER NOT NULL,
+  sev2 INTEGER NOT NULL,
+  sev1 INTEGER NOT NULL,
+  FOREIGN KEY (run_id) REFERENCES run_meta(id)
+);
+
 CREATE INDEX IF NOT EXISTS idx_moves_run_game ON moves(run_id, game_id);
+CREATE INDEX IF NOT EXISTS idx_moves_gid ON moves(game_id);
+CREATE INDEX IF NOT EXISTS idx_moves_run_losses ON moves(run_id, cp_loss, time_spent_sec);
 CREATE INDEX IF NOT EXISTS idx_drills_run_severity ON drills(run_id, severity DESC);
 CREATE INDEX IF NOT EXISTS idx_drills_game_ply ON drills(game_id, ply);
 """
 
+GAME_COLS = ("game_id", "date_utc", "white", "black", "time_control", "result", "termination")
+MOVE_COLS = ("run_id", "game_id", "ply", "side", "phase", "san", "fen_id",
+             "clock_after_sec", "time_spent_sec", "eval_before_cp", "eval_after_cp", "cp_loss",
+             "flags")
+DRILL_COLS = ("drill_id", "run_id", "game_id", "ply", "side", "phase", "san_played", "fen_before",
+              "time_spent_sec", "clock_after_sec", "cp_loss", "engine_best_san",
+              "eval_before_cp", "eval_after_cp", "pv_best", "pv_best_preview", "severity", "tags", "difficulty",
+              "created_at")
+
+def _insert_sql(verb: str, table: str, cols: Tuple[str, ...]) -> str:
+    return f"{verb} INTO {table}({', '.join(cols)}) VALUES({','.join('?' * len(cols))})"
+
+INSERT_GAME_SQL = _insert_sql("INSERT OR IGNORE", "games", GAME_COLS)
+INSERT_MOVES_SQL = _insert_sql("INSERT", "moves", MOVE_COLS)
+INSERT_DRILLS_SQL = _insert_sql("INSERT OR REPLACE", "drills", DRILL_COLS)
+INSERT_FENS_SQL = _insert_sql("INSERT OR IGNORE", "fens", ("fen_id", "fen"))
+INSERT_EVAL_CACHE_SQL = _insert_sql("INSERT OR IGNORE", "eval_cache", ("zkey", "depth", "score_cp", "pv", "seq"))
+
+# Сколько строк moves копим в памяти перед записью одной транзакцией
+INSERT_BATCH_ROWS = 500
+
 # ---------- SHARED UTILITIES ----------
 def open_db(path: str) -> sqlite3.Connection:
     """Открытие базы данных с инициализацией схемы"""
     # Создаем директорию если не существует
     Path(path).parent.mkdir(parents=True, exist_ok=True)
     
-    conn = sqlite3.connect(path)
+    # isolation_level=None: транзакции открываем явно (BEGIN/COMMIT),
+    # иначе sqlite3 оборачивает каждый DML в неявный DEFERRED BEGIN
+    conn = sqlite3.connect(path, isolation_level=None)
     conn.execute("PRAGMA foreign_keys=ON;")
+    # PRAGMA действуют на соединение, поэтому выставляем их при каждом открытии
+    journal_mode = conn.execute("PRAGMA journal_mode=WAL;").fetchone()[0]
+    assert journal_mode == "wal", f"WAL is not available for {path}: {journal_mode}"
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA mmap_size=268435456;")
+    conn.execute("PRAGMA cache_size=-131072;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
     conn.executescript(SCHEMA_SQL)
+    migrate_schema(conn)
+    # строки как sqlite3.Row: доступ по имени колонки без dict на каждую строку
+    conn.row_factory = sqlite3.Row
     return conn
 
-def init_engine(path: str) -> Optional[chess.engine.SimpleEngine]:
-    """Инициализация движка"""
+def migrate_schema(conn: sqlite3.Connection):
+    """Догоняет схему баз, созданных до появления новых колонок (CREATE IF NOT EXISTS их не добавит)"""
+    move_cols = {r[1] for r in conn.execute("PRAGMA table_info(moves)")}
+    if "flags" not in move_cols:
+        # раньше мотивы хранились пятью колонками is_*; новые строки пишут только flags
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("ALTER TABLE moves ADD COLUMN flags INTEGER")
+        conn.execute("""UPDATE moves SET flags = COALESCE(is_check, 0) | (COALESCE(is_capture, 0) << 1)
+                        | (COALESCE(is_pawn_push, 0) << 2) | (COALESCE(is_promotion, 0) << 3)
+                        | (COALESCE(is_castle, 0) << 4)""")
+        conn.commit()
+    if "fen_id" not in move_cols:
+        # старые строки сохраняют fen_before, новые ссылаются на fens
+        conn.execute("ALTER TABLE moves ADD COLUMN fen_id INTEGER")
+    if "seq" not in {r[1] for r in conn.execute("PRAGMA table_info(eval_cache)")}:
+        # старые оценки получают seq = 0 и при обрезке уходят первыми
+        conn.execute("ALTER TABLE eval_cache ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_eval_cache_seq ON eval_cache(seq)")
+    drill_cols = {r[1] for r in conn.execute("PRAGMA table_info(drills)")}
+    if "pv_best_preview" not in drill_cols:
+        # превью для старых дриллов собираем из JSON один раз здесь, а не при каждом ответе
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("ALTER TABLE drills ADD COLUMN pv_best_preview TEXT")
+        rows = conn.execute("SELECT drill_id, pv_best FROM drills WHERE pv_best IS NOT NULL").fetchall()
+        conn.executemany("UPDATE drills SET pv_best_preview = ? WHERE drill_id = ?",
+                         [(pv_preview(json.loads(pv)), drill_id) for drill_id, pv in rows])
+        conn.commit()
+
+def init_engine(path: str, hash_mb: int = 128) -> Optional[chess.engine.SimpleEngine]:
+    """Инициализация движка; hash_mb — на каждый движок пула, как в init_engine_async"""
     if not path or not os.path.exists(path):
         print(f"[WARN] Stockfish not found at '{path}'")
         return None
     try:
         eng = chess.engine.SimpleEngine.popen_uci(path)
         try: 
-            eng.configure({"Threads": 1, "Hash": 64})
+            # 128 MB хватает, чтобы TT пережила всю партию (ucinewgame только между партиями),
+            # и пул из cpu_count()//2 движков не съедает гигабайты
+            eng.configure({"Threads": 1, "Hash": hash_mb})
         except Exception: 
             pass
         print(f"[INFO] Stockfish initialized: {eng.id}")
@@ -182,8 +322,19 @@ def init_engine(path: str) -> Optional[chess.engine.SimpleEngine]:
         print(f"[WARN] Cannot start engine '{path}': {e}")
         return None
 
-async def init_engine_async(path: str) -> Optional[chess.engine.SimpleEngine]:
-    """Асинхронная инициализация движка"""
+def pin_to_cpu(pid: int, slot: int):
+    """Привязка процесса к одному из доступных ядер, чтобы движки пула не мигрировали между ядрами"""
+    if not hasattr(os, "sched_setaffinity"):  # только Linux
+        return
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(pid, {cpus[slot % len(cpus)]})
+    except OSError as e:
+        print(f"[WARN] Cannot pin engine to CPU: {e}")
+
+async def init_engine_async(path: str, cpu_slot: Optional[int] = None,
+                            hash_mb: int = 128) -> Optional[chess.engine.SimpleEngine]:
+    """Асинхронная инициализация движка; cpu_slot — номер движка в пуле для привязки к ядру"""
     if not path:
         print("[WARN] No Stockfish path provided")
         return None
@@ -202,7 +353,9 @@ async def init_engine_async(path: str) -> Optional[chess.engine.SimpleEngine]:
     
     try:
         transport, eng = await chess.engine.popen_uci(path)
-        await eng.configure({"Threads": 1, "Hash": 64})
+        await eng.configure({"Threads": 1, "Hash": hash_mb})
+        if cpu_slot is not None:
+            pin_to_cpu(transport.get_pid(), cpu_slot)
         print(f"[INFO] Stockfish initialized async: {eng.id}")
         # Store transport in engine for cleanup
         eng._transport = transport
@@ -214,9 +367,16 @@ async def init_engine_async(path: str) -> Optional[chess.engine.SimpleEngine]:
         return None
 
 # ---------- TRAINER FUNCTIONS ----------
+HTTP_POOL_SIZE = 8
+
+@functools.lru_cache(maxsize=None)
 def make_session(user_agent: str) -> requests.Session:
+    """Одна сессия на user agent: keep-alive к api.chess.com переживает повторные /update"""
     s = requests.Session()
+    # Accept-Encoding не трогаем: requests сам добавляет br, если установлен brotli
     s.headers.update({"User-Agent": user_agent, "Accept": "application/json, text/plain, */*"})
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+    s.mount("https://", adapter)
     return s
 
 def http_get(session: requests.Session, url: str, max_retry: int, backoff: float, expect_json: bool):
@@ -245,249 +405,463 @@ def get_archives(session: requests.Session, username: str, max_retry: int, backo
     data = http_get(session, url, max_retry, backoff, expect_json=True)
     return data.get("archives", [])
 
-def fetch_archive_pgn(session: requests.Session, archive_url: str, max_retry: int, backoff: float) -> str:
-    pgn_url = archive_url + "/pgn"
-    try:
-        return http_get(session, pgn_url, max_retry, backoff, expect_json=False)
-    except Exception:
-        js = http_get(session, archive_url, max_retry, backoff, expect_json=True)
-        pgns = [g.get("pgn", "") for g in js.get("games", []) if g.get("pgn")]
-        return "\n\n".join(pgns)
+def archive_json_to_pgn(js: dict, only_5plus0: bool) -> str:
+    """PGN партий из JSON архива; time_control есть в JSON, так что фильтр 5+0 — до разбора PGN"""
+    pgns = [g["pgn"] for g in js.get("games", [])
+            if g.get("pgn") and (not only_5plus0 or g.get("time_control") in FIVE_PLUS_ZERO_TC)]
+    return "\n\n".join(pgns)
+
+def fetch_archive_games(session: requests.Session, archive_url: str, max_retry: int, backoff: float,
+                        only_5plus0: bool) -> str:
+    js = http_get(session, archive_url, max_retry, backoff, expect_json=True)
+    return archive_json_to_pgn(js, only_5plus0)
+
+async def http_get_async(session: "aiohttp.ClientSession", url: str, max_retry: int, backoff: float,
+                         expect_json: bool):
+    """Асинхронный аналог http_get с тем же retry/backoff"""
+    attempt = 0
+    while True:
+        try:
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=60)) as r:
+                if r.status == 200:
+                    return await r.json(content_type=None) if expect_json else await r.text()
+                if r.status in (403, 429) or 500 <= r.status < 600:
+                    attempt += 1
+                    if attempt > max_retry: r.raise_for_status()
+                    sleep_for = backoff * (2 ** (attempt - 1))
+                    print(f"[WARN] {r.status} {url}; retry {attempt}/{max_retry} in {sleep_for:.1f}s")
+                    await asyncio.sleep(sleep_for); continue
+                r.raise_for_status()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            attempt += 1
+            if attempt > max_retry: raise
+            sleep_for = backoff * (2 ** (attempt - 1))
+            print(f"[WARN] {e}; retry {attempt}/{max_retry} in {sleep_for:.1f}s")
+            await asyncio.sleep(sleep_for)
+
+async def get_archives_async(session: "aiohttp.ClientSession", username: str, max_retry: int,
+                             backoff: float) -> List[str]:
+    url = f"https://api.chess.com/pub/player/{username}/games/archives"
+    data = await http_get_async(session, url, max_retry, backoff, expect_json=True)
+    return data.get("archives", [])
+
+async def fetch_archive_games_async(session: "aiohttp.ClientSession", archive_url: str, max_retry: int,
+                                    backoff: float, only_5plus0: bool) -> str:
+    js = await http_get_async(session, archive_url, max_retry, backoff, expect_json=True)
+    return archive_json_to_pgn(js, only_5plus0)
 
 def parse_clock(comment: str) -> Optional[int]:
-    if not comment: return None
+    # подстрока проверяется быстрее, чем запуск регулярки на комментарии без часов
+    if not comment or "[%clk" not in comment: return None
     m = CLK_RE.search(comment)
     if not m: return None
-    t = m.group(1).strip()
-    parts = [int(x) for x in t.split(":")]
-    if len(parts)==2: mm,ss = parts; return mm*60+ss
-    if len(parts)==3: hh,mm,ss = parts; return hh*3600+mm*60+ss
-    return None
-
-def parse_pgn_games(pgn_text: str) -> List[chess.pgn.Game]:
-    games = []; pgn_io = io.StringIO(pgn_text)
+    return int(m[1] or 0)*3600 + int(m[2])*60 + int(float(m[3]))
+
+def game_id(headers: chess.pgn.Headers) -> str:
+    date = headers.get("UTCDate", headers.get("Date",""))
+    return f"{date}_{headers.get('White','')}_vs_{headers.get('Black','')}".strip("_")
+
+def game_row(headers: chess.pgn.Headers) -> tuple:
+    """Строка games (в порядке GAME_COLS) за один проход по заголовкам"""
+    get = headers.get
+    white, black, result, termination, time_control = (
+        get("White",""), get("Black",""), get("Result",""), get("Termination",""), get("TimeControl",""))
+    date = get("UTCDate", get("Date",""))  # как в game_id
+    gid = f"{date}_{white}_vs_{black}".strip("_")
+    return (gid, date, white, black, time_control, result, termination)
+
+def iter_pgn_games(pgn_text: str, skip=None) -> Iterator[chess.pgn.Game]:
+    """Партии из PGN по одной, без материализации всего архива в список.
+
+    skip(headers) -> True отбрасывает партию по заголовкам: ходы и комментарии не разбираются."""
+    pgn_io = io.StringIO(pgn_text)
     while True:
-        game = chess.pgn.read_game(pgn_io)
-        if game is None: break
-        games.append(game)
-    return games
+        if skip is None:
+            game = chess.pgn.read_game(pgn_io)
+            if game is None: return
+            yield game
+            continue
+        offset = pgn_io.tell()
+        headers = chess.pgn.read_headers(pgn_io)
+        if headers is None: return
+        if skip(headers): continue
+        pgn_io.seek(offset)
+        yield chess.pgn.read_game(pgn_io)
+
+def load_games(pgn_text: str, only_5plus0: bool, skip=None) -> List[chess.pgn.Game]:
+    """Партии из PGN; фильтр 5+0 и skip применяются к заголовкам до разбора ходов"""
+    if not only_5plus0 and skip is None:
+        return list(iter_pgn_games(pgn_text))
+    def skip_headers(headers):
+        if only_5plus0 and headers.get("TimeControl","") not in FIVE_PLUS_ZERO_TC: return True
+        return skip is not None and skip(headers)
+    return list(iter_pgn_games(pgn_text, skip_headers))
 
 def is_5plus0_game(game: chess.pgn.Game) -> bool:
     tc = game.headers.get("TimeControl","")
-    return tc in ("300", "300+0")
-
-def phase_from_ply(ply: int) -> str:
-    if ply <= OPENING_PLY: return "opening"
-    if ply <= MIDDLEGAME_PLY: return "middlegame"
-    return "endgame"
-
-def san_motif_flags(san: str) -> Dict[str,int]:
-    return {
-        "is_check": 1 if "+" in san else 0,
-        "is_mate": 1 if "#" in san else 0,
-        "is_capture": 1 if "x" in san else 0,
-        "is_pawn_push": 1 if san and san[0] in "abcdefgh" else 0,
-        "is_promotion": 1 if "=" in san else 0,
-        "is_castle": 1 if san in ("O-O","O-O-O") else 0,
-    }
-
-def analyze_position(eng: chess.engine.SimpleEngine, board: chess.Board, depth: int, movetime: float):
+    return tc in FIVE_PLUS_ZERO_TC
+
+# Фаза партии по номеру полухода; за пределами таблицы — всегда эндшпиль
+_PHASE_LUT_SIZE = 512
+_PHASE_LUT = tuple("opening" if p <= OPENING_PLY else "middlegame" if p <= MIDDLEGAME_PLY else "endgame"
+                   for p in range(_PHASE_LUT_SIZE))
+
+_PAWN_FILES = frozenset("abcdefgh")
+_CASTLE_SANS = frozenset(("O-O", "O-O-O"))
+
+FLAG_CHECK = 1
+FLAG_CAPTURE = 2
+FLAG_PAWN_PUSH = 4
+FLAG_PROMOTION = 8
+FLAG_CASTLE = 16
+
+def san_motif_flags(san: str) -> int:
+    """Мотивы хода по SAN, упакованные в биты FLAG_*"""
+    return (("+" in san) | (("x" in san) << 1) | ((san[:1] in _PAWN_FILES) << 2)
+            | (("=" in san) << 3) | ((san in _CASTLE_SANS) << 4))
+
+# Маска дрилла: биты 0-4 — теги в порядке _TAG_NAMES, бит 5 — cp_loss >= SEVERE_BLUNDER_CP,
+# бит 6 — сложность medium; все метки дрилла берутся из одной таблицы по маске
+_TAG_NAMES = ("blunder", "long-think", "check", "capture", "pawn-push")
+_DRILL_SEVERE = 1 << 5
+_DRILL_MEDIUM = 1 << 6
+# (is_blunder | is_long << 1 | is_severe << 2) -> severity
+_SEV_TABLE = (0, 1, 0, 2, 3, 3, 3, 3)
+
+def _drill_labels_row(mask: int) -> Tuple[int, str, str]:
+    severity = _SEV_TABLE[(mask & 3) | (mask >> 3 & 4)]
+    tags = ",".join(n for i, n in enumerate(_TAG_NAMES) if mask >> i & 1)
+    return severity, tags, "medium" if mask & _DRILL_MEDIUM else "easy"
+
+_DRILL_LUT = tuple(_drill_labels_row(m) for m in range(1 << 7))
+
+def drill_labels(cp_loss: Optional[int], is_blunder: bool, is_long: bool, flags: int) -> Tuple[int, str, str]:
+    """(severity, tags, difficulty) дрилла одним обращением к таблице по битовой маске"""
+    # шах/взятие/ход пешкой — младшие биты flags, в тегах они идут после blunder и long-think
+    mask = (is_blunder | (is_long << 1) | ((flags & (FLAG_CHECK | FLAG_CAPTURE | FLAG_PAWN_PUSH)) << 2)
+            | (_DRILL_SEVERE if cp_loss is not None and cp_loss >= SEVERE_BLUNDER_CP else 0)
+            | (0 if cp_loss and cp_loss < 250 else _DRILL_MEDIUM))
+    return _DRILL_LUT[mask]
+
+def position_key(board: chess.Board) -> int:
+    """Zobrist-хэш позиции как знаковое 64-битное целое (так его хранит SQLite)"""
+    z = chess.polyglot.zobrist_hash(board)
+    return z - (1 << 64) if z >= (1 << 63) else z
+
+def make_drill_id(gid: str, ply: int, fen_before: str, engine_best_san: Optional[str]) -> str:
+    """Детерминированный id дрилла: 16 hex-символов BLAKE2b"""
+    src = f"{gid}|{ply}|{fen_before}|{engine_best_san or ''}"
+    return blake2b(src.encode(), digest_size=8).hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def engine_limit(depth: int, movetime: float = 0) -> chess.engine.Limit:
+    """Один объект Limit на пару (depth, movetime): движок его не меняет, а вызовов — по два на полуход"""
+    return chess.engine.Limit(depth=depth) if movetime <= 0 else chess.engine.Limit(time=movetime)
+
+def analyze_position(eng: chess.engine.SimpleEngine, board: chess.Board, depth: int, movetime: float,
+                     game: object = None):
+    """game — идентификатор партии: python-chess шлет ucinewgame только при его смене,
+    так что таблица транспозиций движка живет в пределах одной партии"""
     if eng is None: return None
-    limit = chess.engine.Limit(depth=depth) if movetime <= 0 else chess.engine.Limit(time=movetime)
-    try: return eng.analyse(board, limit)
+    try: return eng.analyse(board, engine_limit(depth, movetime), game=game)
     except Exception as e:
         print(f"[WARN] Engine analyse failed: {e}"); return None
 
+MATE_SCORE_CP = 30000
+# Потери считаются по оценкам с матом ±MATE_SCORE_CP; упущенный мат дал бы 30000–60000 cp
+# и исказил бы средние и подписи, поэтому хранимая и показываемая потеря ограничена ±CP_LOSS_CAP
+CP_LOSS_CAP = 2000
+
 def cp_from_info(info) -> Optional[int]:
+    """Оценка с точки зрения белых; мат переводится в ±MATE_SCORE_CP, чтобы не терять зевки мата"""
     if not info: return None
-    sc = info.get("score"); 
-    if not sc: return None
-    try: return sc.pov(chess.WHITE).score()
-    except Exception:
-        try: return sc.white().score()
-        except Exception: return None
-
-def pv_to_san(board_before: chess.Board, pv_moves) -> Tuple[str, str]:
-    """Return best_san and pv SAN list as JSON string."""
-    if not pv_moves: return None, "[]"
-    b = board_before.copy()
+    sc = info.get("score")
+    if sc is None: return None
+    return sc.pov(chess.WHITE).score(mate_score=MATE_SCORE_CP)
+
+def mover_cp_loss(eval_before: int, eval_after: int, side: str) -> int:
+    """Потеря с точки зрения ходившего, ограниченная ±CP_LOSS_CAP"""
+    loss_white_pov = eval_before - eval_after
+    loss = loss_white_pov if side == "W" else -loss_white_pov
+    return max(-CP_LOSS_CAP, min(loss, CP_LOSS_CAP))
+
+PV_SAN_PREFIX = 5  # столько ходов варианта бот показывает пользователю
+
+def pv_preview(san_list: List[str]) -> Optional[str]:
+    """Вариант для ответа пользователю; из одного хода вариант не показываем"""
+    return " ".join(san_list[:PV_SAN_PREFIX]) if len(san_list) > 1 else None
+
+def pv_to_san(board_before: chess.Board, pv_moves,
+              max_san: int = PV_SAN_PREFIX) -> Tuple[Optional[str], str, Optional[str]]:
+    """Return best_san, pv list as JSON string (первые max_san ходов в SAN, остальные как "uci:...")
+    и готовое превью варианта."""
+    if not pv_moves: return None, "[]", None
+    b = board_before.copy(stack=False)
     san_list = []
-    best_san = None
-    for i, mv in enumerate(pv_moves):
+    for mv in pv_moves[:max_san]:
         try:
             san = b.san(mv)
         except Exception:
             break
         san_list.append(san)
-        if i==0: best_san = san
         b.push(mv)
-    return best_san, json.dumps(san_list, ensure_ascii=False)
-
-def analyze_and_store(conn: sqlite3.Connection, games: List[chess.pgn.Game], username: str,
-                      only_5plus0: bool, eng, depth, movetime, max_positions, sample_every,
-                      run_id: int):
-    """Основная функция анализа и сохранения"""
-    cur = conn.cursor()
-    eval_used = 0
-
-    it = games if not tqdm else tqdm(games, desc="Analyze", unit="game")
-    for game in it:
-        if only_5plus0 and not is_5plus0_game(game):
-            continue
-
-        white = game.headers.get("White","")
-        black = game.headers.get("Black","")
-        date = game.headers.get("UTCDate", game.headers.get("Date",""))
-        result = game.headers.get("Result","")
-        termination = game.headers.get("Termination","")
-        time_control = game.headers.get("TimeControl","")
-        gid = f"{date}_{white}_vs_{black}".strip("_")
-
-        # upsert game
-        cur.execute("""INSERT OR IGNORE INTO games(game_id, date_utc, white, black, time_control, result, termination)
-                       VALUES(?,?,?,?,?,?,?)""", (gid, date, white, black, time_control, result, termination))
-
-        board = game.board()
-        node = game
-        ply = 0
-        last_clock = {"W": None, "B": None}
-
-        while node.variations:
-            next_node = node.variation(0)
-            san = next_node.san()
-            ply += 1
-
-            side = "W" if board.turn == chess.WHITE else "B"
-            phase = phase_from_ply(ply)
-
-            # sampling
-            sample_skip = (sample_every > 1 and (ply % sample_every) != 0)
-
-            # BEFORE eval
-            eval_before = None
-            info_before = None
-            if not sample_skip and eng and eval_used < max_positions:
-                info_before = analyze_position(eng, board, depth, movetime)
-                eval_before = cp_from_info(info_before)
-
-            # Записываем FEN ДО хода
-            fen_before = board.fen()
-            
-            # Получаем ход из SAN для текущей позиции
-            try:
-                move = board.parse_san(san)
-            except ValueError as e:
-                print(f"[ERROR] Cannot parse SAN '{san}' for position {fen_before}: {e}")
-                break
-            
-            # timing
-            comment = next_node.comment
-            clk_after = parse_clock(comment)
-            time_spent = None
-            if clk_after is not None and last_clock[side] is not None:
-                dt = last_clock[side] - clk_after
-                if dt >= 0: time_spent = dt
-
-            # push
-            board.push(move)
-            
-            # Переходим к следующему узлу
-            node = next_node
+    else:
+        # хвост варианта нужен только для отладки — без доски и SAN
+        san_list.extend(f"uci:{mv.uci()}" for mv in pv_moves[max_san:])
+    best_san = san_list[0] if san_list else None
+    return best_san, json.dumps(san_list, ensure_ascii=False), pv_preview(san_list)
+
+def record_ply(moves_rows: List[tuple], drills_rows: List[tuple], run_id: int, gid: str, ply: int,
+               side: str, phase: str, san: str, fen_id: int, fen_before: str,
+               clk_after: Optional[int], time_spent: Optional[int], eval_before: Optional[int],
+               eval_after: Optional[int], cp_loss: Optional[int], board_before: Optional[chess.Board],
+               pv: Optional[List[chess.Move]], created_at: str) -> None:
+    """Строка moves и, если ход тянет на дрилл, строка drills для одного полухода.
+
+    Общая синхронная часть тренера и бота, без движка и await; типы расставлены
+    так, чтобы функцию можно было собрать mypyc отдельно от корутин."""
+    flags = san_motif_flags(san)
+    moves_rows.append((run_id, gid, ply, side, phase, san, fen_id, clk_after, time_spent,
+                       eval_before, eval_after, cp_loss, flags))
+
+    # DRILL candidate?
+    is_blunder = cp_loss is not None and cp_loss >= BLUNDER_CP
+    is_long = time_spent is not None and time_spent > LONG_THINK_SEC
+    if not (is_blunder or is_long):
+        return
 
-            # AFTER eval
-            eval_after = None
-            if not sample_skip and eng and eval_used < max_positions:
-                info_after = analyze_position(eng, board, depth, movetime)
-                eval_after = cp_from_info(info_after)
-                eval_used += 2
-                if tqdm: it.set_postfix_str(f"engine_pos≈{eval_used}/{max_positions}")
+    # лучший ход — из PV позиции до хода, если он был
+    engine_best_san = None
+    pv_best = "[]"
+    preview = None
+    if board_before is not None and pv:
+        engine_best_san, pv_best, preview = pv_to_san(board_before, pv)
 
-            # cp loss for mover pov
-            cp_loss = None
-            if eval_before is not None and eval_after is not None:
-                loss_white_pov = eval_before - eval_after
-                cp_loss = loss_white_pov if side == "W" else -loss_white_pov
+    severity, tags, difficulty = drill_labels(cp_loss, is_blunder, is_long, flags)
 
-            flags = san_motif_flags(san)
+    # deterministic drill_id
+    drill_id = make_drill_id(gid, ply, fen_before, engine_best_san)
 
-            # update last clock for mover
-            if clk_after is not None:
-                last_clock[side] = clk_after
-
-            # insert move
-            cur.execute("""INSERT INTO moves(run_id, game_id, ply, side, phase, san, fen_before,
-                                             clock_after_sec, time_spent_sec, eval_before_cp, eval_after_cp, cp_loss,
-                                             is_check, is_capture, is_pawn_push, is_promotion, is_castle)
-                           VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-                        (run_id, gid, ply, side, phase, san, fen_before, clk_after, time_spent,
-                         eval_before, eval_after, cp_loss,
-                         flags["is_check"], flags["is_capture"], flags["is_pawn_push"],
-                         flags["is_promotion"], flags["is_castle"]))
-
-            # DRILL candidate?
-            is_blunder = (cp_loss is not None and cp_loss >= BLUNDER_CP)
-            is_long = (time_spent is not None and time_spent > LONG_THINK_SEC)
-
-            if is_blunder or is_long:
-                # derive best move from info_before if available
-                engine_best_san = None
-                pv_best = "[]"
-                if info_before and "pv" in info_before and info_before["pv"]:
-                    # Создаем новую доску из FEN до хода для анализа PV
-                    board_for_pv = chess.Board(fen_before)
-                    engine_best_san, pv_best = pv_to_san(board_for_pv, info_before["pv"])
-
-                # severity ranking
-                if cp_loss is not None and cp_loss >= SEVERE_BLUNDER_CP:
-                    severity = 3
-                elif is_blunder and is_long:
-                    severity = 2
-                elif is_blunder:
-                    severity = 1
-                else:
-                    severity = 0
-
-                tags = []
-                if is_blunder: tags.append("blunder")
-                if is_long:    tags.append("long-think")
-                if flags["is_check"]: tags.append("check")
-                if flags["is_capture"]: tags.append("capture")
-                if flags["is_pawn_push"]: tags.append("pawn-push")
-
-                # deterministic drill_id
-                import hashlib
-                src = f"{gid}|{ply}|{fen_before}|{engine_best_san or ''}"
-                drill_id = hashlib.sha1(src.encode()).hexdigest()[:16]
-
-                cur.execute("""INSERT OR REPLACE INTO drills(
-                                  drill_id, run_id, game_id, ply, side, phase, san_played, fen_before,
-                                  time_spent_sec, clock_after_sec, cp_loss, engine_best_san,
-                                  eval_before_cp, eval_after_cp, pv_best, severity, tags, difficulty, created_at)
-                               VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-                            (drill_id, run_id, gid, ply, side, phase, san, fen_before, time_spent, clk_after,
-                             cp_loss, engine_best_san, eval_before, eval_after, pv_best, severity,
-                             ",".join(tags), "easy" if cp_loss and cp_loss<250 else "medium", datetime.utcnow().isoformat()+"Z"))
+    drills_rows.append((drill_id, run_id, gid, ply, side, phase, san, fen_before, time_spent, clk_after,
+                        cp_loss, engine_best_san, eval_before, eval_after, pv_best, preview, severity,
+                        tags, difficulty, created_at))
 
+def flush_rows(conn: sqlite3.Connection, games_rows: List[tuple], moves_rows: List[tuple],
+               drills_rows: List[tuple], fens_rows: List[tuple]):
+    """Запись накопленных строк одной транзакцией через executemany"""
+    if not (games_rows or moves_rows or drills_rows or fens_rows):
+        return
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    cur = conn.cursor()
+    # games и fens первыми: на них ссылаются moves и drills
+    cur.executemany(INSERT_GAME_SQL, games_rows)
+    cur.executemany(INSERT_FENS_SQL, fens_rows)
+    cur.executemany(INSERT_MOVES_SQL, moves_rows)
+    cur.executemany(INSERT_DRILLS_SQL, drills_rows)
     conn.commit()
+    games_rows.clear(); moves_rows.clear(); drills_rows.clear(); fens_rows.clear()
+
+def is_forced_move(board: chess.Board) -> bool:
+    """Ровно один легальный ход; legal_moves генерируются лениво, поэтому берем не больше двух"""
+    moves = board.generate_legal_moves()
+    return next(moves, None) is not None and next(moves, None) is None
+
+class EvalBudget:
+    """Общий для всех потоков лимит позиций, оцениваемых движком"""
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        return self.used < self.limit
+
+    def take(self):
+        with self._lock:
+            self.used += 1
+
+def init_engine_pool(path: str, size: int = TRAINER_ENGINES) -> List[chess.engine.SimpleEngine]:
+    """Несколько однопоточных движков для параллельного анализа партий"""
+    engines = [init_engine(path) for _ in range(size)]
+    return [e for e in engines if e is not None]
+
+def analyze_game(eng, game: chess.pgn.Game, run_id: int, depth, movetime, budget: EvalBudget,
+                 sample_every, created_at: str,
+                 analyze_opening: bool = False) -> Tuple[tuple, List[tuple], List[tuple], List[tuple]]:
+    """Анализ одной партии; возвращает строки (games, moves, drills, fens) без записи в базу.
+    created_at — метка прогона, общая для всех его дриллов.
+
+    Дебютные полуходы (ply <= OPENING_PLY) движком не оцениваются, если не задан
+    analyze_opening; вынужденные ходы получают cp_loss = 0 без вызова движка."""
+    moves_rows, drills_rows, fens_rows = [], [], []
+
+    row = game_row(game.headers)
+    gid = row[0]
+
+    board = game.board()
+    ply = 0
+    last_clock = {"W": None, "B": None}
+    prev_info_after = None
+
+    # mainline() отдает узлы по порядку, SAN считаем на своей доске, а не через node.san()
+    for node in game.mainline():
+        move = node.move
+        san = board.san(move)
+        ply += 1
+
+        side = "W" if board.turn == chess.WHITE else "B"
+        phase = _PHASE_LUT[ply] if ply < _PHASE_LUT_SIZE else "endgame"
+
+        # sampling
+        sample_skip = (sample_every > 1 and (ply % sample_every) != 0) \
+            or (not analyze_opening and ply <= OPENING_PLY)
+        can_eval = not sample_skip and eng and budget.available()
+        forced = can_eval and is_forced_move(board)
+        use_engine = can_eval and not forced
+
+        # BEFORE eval: позиция до хода — это позиция после прошлого полухода,
+        # поэтому движок вызываем только если ее оценки еще нет
+        info_before = None
+        if can_eval:
+            info_before = prev_info_after
+            if info_before is None and use_engine:
+                info_before = analyze_position(eng, board, depth, movetime, game=gid)
+                budget.take()
+        eval_before = cp_from_info(info_before)
+
+        # FEN ДО хода: в moves — ключ, позиция без счетчиков ходов — в fens
+        fen_before = board.fen()
+        fen_id = position_key(board)
+        fens_rows.append((fen_id, fen_before.rsplit(" ", 2)[0]))
+
+        # timing
+        comment = node.comment
+        clk_after = parse_clock(comment)
+        time_spent = None
+        if clk_after is not None and last_clock[side] is not None:
+            dt = last_clock[side] - clk_after
+            if dt >= 0: time_spent = dt
+
+        # Снимок доски до хода нужен только для PV дрилла — копия дешевле разбора FEN
+        board_before = board.copy(stack=False) if info_before and info_before.get("pv") else None
+
+        # push
+        board.push(move)
+
+        # AFTER eval
+        info_after = None
+        if use_engine:
+            info_after = analyze_position(eng, board, depth, movetime, game=gid)
+            budget.take()
+        eval_after = cp_from_info(info_after)
+        prev_info_after = info_after
+
+        # cp loss for mover pov
+        cp_loss = None
+        if forced:
+            # единственный ход ничего не теряет
+            eval_after = eval_before
+            cp_loss = 0
+        elif eval_before is not None and eval_after is not None:
+            cp_loss = mover_cp_loss(eval_before, eval_after, side)
+
+        # update last clock for mover
+        if clk_after is not None:
+            last_clock[side] = clk_after
+
+        record_ply(moves_rows, drills_rows, run_id, gid, ply, side, phase, san, fen_id, fen_before,
+                   clk_after, time_spent, eval_before, eval_after, cp_loss,
+                   board_before, info_before["pv"] if board_before is not None else None, created_at)
+
+    return row, moves_rows, drills_rows, fens_rows
+
+def analyze_and_store(conn: sqlite3.Connection, games: Iterable[chess.pgn.Game], username: str,
+                      only_5plus0: bool, engines: List[chess.engine.SimpleEngine], depth, movetime,
+                      max_positions, sample_every, run_id: int, analyze_opening: bool = False):
+    """Основная функция анализа и сохранения.
+
+    Партии анализируются параллельно: по потоку на движок из engines (см. init_engine_pool),
+    движок выдается потоку в монопольное пользование — SimpleEngine не потокобезопасен.
+    В SQLite пишет только вызывающий поток."""
+    budget = EvalBudget(max_positions)
+    games_rows, moves_rows, drills_rows, fens_rows = [], [], [], []
+    engines = list(engines) or [None]
+    created_at = datetime.utcnow().isoformat()+"Z"
+
+    free_engines = queue.Queue()
+    for e in engines:
+        free_engines.put(e)
+
+    def worker(game):
+        eng = free_engines.get()
+        try:
+            return analyze_game(eng, game, run_id, depth, movetime, budget, sample_every, created_at,
+                                analyze_opening)
+        finally:
+            free_engines.put(eng)
+
+    bar = tqdm(desc="Analyze", unit="game") if tqdm else None
+
+    def collect(future):
+        row, game_moves, game_drills, game_fens = future.result()
+        games_rows.append(row)
+        moves_rows.extend(game_moves)
+        drills_rows.extend(game_drills)
+        fens_rows.extend(game_fens)
+        if bar is not None:
+            bar.update(1)
+            bar.set_postfix_str(f"engine_pos≈{budget.used}/{max_positions}")
+        # партия целиком попадает в одну пачку
+        if len(moves_rows) >= INSERT_BATCH_ROWS:
+            flush_rows(conn, games_rows, moves_rows, drills_rows, fens_rows)
+
+    # В полете держим не больше двух партий на движок, чтобы не держать в памяти весь поток партий;
+    # результаты забираем в порядке подачи
+    with ThreadPoolExecutor(max_workers=len(engines)) as pool:
+        pending = deque()
+        for game in games:
+            if only_5plus0 and not is_5plus0_game(game):
+                continue
+            pending.append(pool.submit(worker, game))
+            if len(pending) >= 2 * len(engines):
+                collect(pending.popleft())
+        while pending:
+            collect(pending.popleft())
+
+    if bar is not None:
+        bar.close()
+    flush_rows(conn, games_rows, moves_rows, drills_rows, fens_rows)
+
+def refresh_run_stats(conn: sqlite3.Connection, run_id: int):
+    """Пересчет агрегатов дриллов прогона в run_stats"""
+    conn.execute("""INSERT OR REPLACE INTO run_stats(run_id, total, avg_cp_loss, sev3, sev2, sev1)
+                    SELECT ?, COUNT(*), AVG(cp_loss),
+                           COUNT(CASE WHEN severity >= 3 THEN 1 END),
+                           COUNT(CASE WHEN severity = 2 THEN 1 END),
+                           COUNT(CASE WHEN severity = 1 THEN 1 END)
+                    FROM drills WHERE run_id = ?""", (run_id, run_id))
+
+def get_run_stats(conn: sqlite3.Connection, run_id: int) -> sqlite3.Row:
+    """Агрегаты прогона; для прогонов без записи в run_stats считаются один раз и сохраняются"""
+    sql = "SELECT total, avg_cp_loss, sev3, sev2, sev1 FROM run_stats WHERE run_id = ?"
+    row = conn.execute(sql, (run_id,)).fetchone()
+    if row is None:
+        refresh_run_stats(conn, run_id)
+        row = conn.execute(sql, (run_id,)).fetchone()
+    return row
 
 def summarize_stats(conn: sqlite3.Connection, run_id: int):
     """Вывод статистики"""
-    cur = conn.cursor()
-    
-    cur.execute("""SELECT AVG(time_spent_sec) FROM moves WHERE run_id=? AND time_spent_sec IS NOT NULL""", (run_id,))
-    avg_t = cur.fetchone()[0]
-
-    cur.execute("""SELECT AVG(CASE WHEN time_spent_sec> ? THEN 1.0 ELSE 0.0 END)
-                   FROM moves WHERE run_id=? AND time_spent_sec IS NOT NULL""", (LONG_THINK_SEC, run_id))
-    p_long = cur.fetchone()[0]
-
-    cur.execute("""SELECT AVG(CASE WHEN time_spent_sec< ? THEN 1.0 ELSE 0.0 END)
-                   FROM moves WHERE run_id=? AND time_spent_sec IS NOT NULL""", (FAST_MOVE_SEC, run_id))
-    p_fast = cur.fetchone()[0]
-
-    cur.execute("""SELECT AVG(CASE WHEN cp_loss>= ? THEN 1.0 ELSE 0.0 END)
-                   FROM moves WHERE run_id=? AND cp_loss IS NOT NULL""", (BLUNDER_CP, run_id))
-    p_bl = cur.fetchone()[0]
+    # Один проход по moves: сравнение с NULL дает NULL, а AVG пропускает NULL,
+    # так что каждая доля считается только по строкам с известным значением
+    avg_t, p_long, p_fast, p_bl = conn.execute(
+        """SELECT AVG(time_spent_sec),
+                  AVG((time_spent_sec > ?) * 1.0),
+                  AVG((time_spent_sec < ?) * 1.0),
+                  AVG((cp_loss >= ?) * 1.0)
+           FROM moves WHERE run_id=?""",
+        (LONG_THINK_SEC, FAST_MOVE_SEC, BLUNDER_CP, run_id)).fetchone()
 
     print("\n== Training Statistics ==")
     print(f"avg_time_per_move: {None if avg_t is None else round(avg_t,1)} sec")
@@ -496,30 +870,230 @@ def summarize_stats(conn: sqlite3.Connection, run_id: int):
     print(f"blunder_rate(≥{BLUNDER_CP}cp): {None if p_bl is None else round(p_bl*100,1)}%")
 
 # ---------- BOT FUNCTIONS ----------
+def render_board_png_bytes(fen: str, last_move_san: Optional[str], flipped: bool) -> bytes:
+    """Рендер доски без кэша. Функция модуля, чтобы ее можно было отдать в RENDER_POOL;
+    исключения пробрасываются, чтобы ошибки не попадали в кэш"""
+    board = chess.Board(fen)
+
+    # Определяем последний ход если передан
+    last_move = None
+    if last_move_san:
+        try:
+            # Создаем временную доску для парсинга хода
+            temp_board = chess.Board(fen)
+            temp_board.pop()  # Откатываем последний ход
+            last_move = temp_board.parse_san(last_move_san)
+        except:
+            pass
+
+    # Генерируем SVG
+    svg_data = chess.svg.board(
+        board, 
+        size=BOARD_SIZE,
+        coordinates=True,
+        flipped=flipped,
+        lastmove=last_move,
+        style="""
+        .square.light { fill: #f0d9b5; }
+        .square.dark { fill: #b58863; }
+        .coord { font-size: 14px; font-family: Arial; }
+        .square.lastmove { fill: rgba(255, 255, 0, 0.4); }
+        """
+    )
+
+    # Конвертируем SVG в PNG
+    if CAIROSVG_AVAILABLE:
+        png_data = cairosvg.svg2png(bytestring=svg_data.encode('utf-8'),
+                                    output_width=BOARD_SIZE, output_height=BOARD_SIZE)
+        return png_data
+    else:
+        return _render_simple_board(board, flipped)
+
+def _render_simple_board(board: chess.Board, flipped: bool = False) -> bytes:
+    """Простая отрисовка доски без SVG"""
+    if not TELEGRAM_AVAILABLE:
+        return b''
+
+    img = Image.new('RGB', (BOARD_SIZE, BOARD_SIZE), 'white')
+    draw = ImageDraw.Draw(img)
+
+    square_size = BOARD_SIZE // 8
+
+    # Рисуем клетки
+    for rank in range(8):
+        for file in range(8):
+            # Поворачиваем координаты если нужно
+            display_rank = 7 - rank if flipped else rank
+            display_file = 7 - file if flipped else file
+
+            x1 = display_file * square_size
+            y1 = (7 - display_rank) * square_size
+            x2 = x1 + square_size
+            y2 = y1 + square_size
+
+            color = '#f0d9b5' if (rank + file) % 2 == 0 else '#b58863'
+            draw.rectangle([x1, y1, x2, y2], fill=color)
+
+    # Добавляем символы фигур: только занятые клетки, а не все 64;
+    # глиф — готовая маска, черный цвет накладывается через нее без FreeType
+    half = square_size // 2
+    sprites = _piece_sprites()
+    ink = (0, 0, 0)
+    for square, piece in board.piece_map().items():
+        file, rank = chess.square_file(square), chess.square_rank(square)
+        display_rank = 7 - rank if flipped else rank
+        display_file = 7 - file if flipped else file
+        text_x = display_file * square_size + half
+        text_y = (7 - display_rank) * square_size + half
+        img.paste(ink, (text_x - half, text_y - half), sprites[(piece.piece_type - 1) | (piece.color << 3)])
+
+    # Сохраняем в байты
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG', compress_level=1, optimize=False)
+    return buffer.getvalue()
+
+# Символы фигур по индексу (piece_type - 1) | (color << 3): белые — 8..13, черные — 0..5
+_PIECE_UNICODE = ('♟', '♞', '♝', '♜', '♛', '♚', '?', '?',
+                  '♙', '♘', '♗', '♖', '♕', '♔', '?', '?')
+
+@functools.lru_cache(maxsize=1)
+def _piece_sprites() -> tuple:
+    """Маски глифов фигур размером с клетку, в том же порядке, что _PIECE_UNICODE.
+    Рисуются один раз тем же шрифтом и с той же привязкой 'mm', что и draw.text раньше"""
+    square_size = BOARD_SIZE // 8
+    sprites = []
+    for glyph in _PIECE_UNICODE:
+        sprite = Image.new('L', (square_size, square_size), 0)
+        ImageDraw.Draw(sprite).text((square_size // 2, square_size // 2), glyph, fill=255, anchor='mm')
+        sprites.append(sprite)
+    return tuple(sprites)
+
 class ChessBot:
     def __init__(self):
         self.engine = None
-        self.user_sessions = {}
+        self.engine_pool = []
+        self._engine_queue = None
+        self.grader_engine = None
+        self._grader_lock = asyncio.Lock()
+        # user_id -> текущий дрилл; без cachetools — обычный dict без вытеснения
+        self.user_sessions = (TTLCache(maxsize=SESSION_CACHE_SIZE, ttl=SESSION_TTL_SEC)
+                              if CACHETOOLS_AVAILABLE else {})
+        # (position_key, depth) -> (score_cp, pv в UCI через пробел); dict хранит порядок вставки -> FIFO
+        self.eval_cache: Dict[Tuple[int, int], Tuple[int, str]] = {}
+        self._eval_cache_loaded = False
+        self._eval_cache_new: List[tuple] = []
+        self.http = None  # aiohttp.ClientSession, создается лениво внутри event loop
         self.admin_users = set()
+        # (позиция, последний ход, разворот) -> PNG; OrderedDict как LRU, т.к. рендер бывает асинхронным
+        self._png_cache: "OrderedDict[Tuple[str, Optional[str], bool], bytes]" = OrderedDict()
+        self._render_pool: Optional[ProcessPoolExecutor] = None
+        # соединение для чтения (дриллы, /stats): схема и миграции — один раз при открытии;
+        # /update пишет через свое соединение
+        self._conn: Optional[sqlite3.Connection] = None
         
     async def init_engine(self):
-        """Инициализация Stockfish для бота"""
-        self.engine = await init_engine_async(STOCKFISH_PATH)
+        """Инициализация пула Stockfish для бота"""
+        engines = await asyncio.gather(*[init_engine_async(STOCKFISH_PATH, cpu_slot=i) for i in range(ENGINE_POOL_SIZE)])
+        self.engine_pool = [e for e in engines if e is not None]
+        self._engine_queue = asyncio.Queue()
+        for eng in self.engine_pool:
+            self._engine_queue.put_nowait(eng)
+        self.engine = self.engine_pool[0] if self.engine_pool else None
+        if self.engine is not None:
+            self.grader_engine = await init_engine_async(STOCKFISH_PATH, hash_mb=GRADER_HASH_MB)
         return self.engine is not None
+
+    @contextlib.asynccontextmanager
+    async def _acquire_engine(self):
+        """Движок из пула: одна команда на движок, иначе python-chess отменит предыдущую"""
+        eng = await self._engine_queue.get()
+        try:
+            yield eng
+        finally:
+            self._engine_queue.put_nowait(eng)
+
+    @contextlib.asynccontextmanager
+    async def _acquire_grader(self):
+        """Движок для analyze_move; если отдельный не запустился — берем из пула"""
+        if self.grader_engine is None:
+            async with self._acquire_engine() as eng:
+                yield eng
+            return
+        async with self._grader_lock:
+            yield self.grader_engine
+
+    def _load_eval_cache(self, conn):
+        """Подгрузка кэша оценок из базы (один раз за жизнь бота): EVAL_CACHE_SIZE самых свежих"""
+        if self._eval_cache_loaded:
+            return
+        rows = conn.execute("SELECT zkey, depth, score_cp, pv FROM eval_cache ORDER BY seq DESC LIMIT ?",
+                            (EVAL_CACHE_SIZE,)).fetchall()
+        # в dict — от старых к новым, чтобы вытеснение шло с самых старых
+        for zkey, depth, score_cp, pv in reversed(rows):
+            self.eval_cache[(zkey, depth)] = (score_cp, pv)
+        self._eval_cache_loaded = True
+
+    def _save_eval_cache(self, conn):
+        """Запись новых оценок, накопленных за /update, и обрезка таблицы до EVAL_CACHE_SIZE"""
+        if not self._eval_cache_new:
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        base = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM eval_cache").fetchone()[0]
+        conn.executemany(INSERT_EVAL_CACHE_SQL,
+                         [row + (base + i,) for i, row in enumerate(self._eval_cache_new, 1)])
+        conn.execute("""DELETE FROM eval_cache WHERE seq <= (
+                            SELECT seq FROM eval_cache ORDER BY seq DESC LIMIT 1 OFFSET ?)""",
+                     (EVAL_CACHE_SIZE,))
+        conn.commit()
+        self._eval_cache_new.clear()
+
+    async def _analyse_cached(self, eng, board: chess.Board, zkey: int, depth: int, game: object,
+                              budget: EvalBudget) -> Dict:
+        """analyse с кэшем по ключу позиции (zkey = position_key(board));
+        движок и бюджет тратятся только на промах"""
+        key = (zkey, depth)
+        hit = self.eval_cache.get(key)
+        if hit is not None:
+            score_cp, pv = hit
+            return {"score": chess.engine.PovScore(chess.engine.Cp(score_cp), chess.WHITE),
+                    "pv": [chess.Move.from_uci(u) for u in pv.split()]}
+
+        info = await eng.analyse(board, engine_limit(depth), game=game)
+        budget.take()
+        score_cp = cp_from_info(info)
+        if score_cp is not None:
+            pv = " ".join(mv.uci() for mv in info.get("pv", []))
+            if len(self.eval_cache) >= EVAL_CACHE_SIZE:
+                del self.eval_cache[next(iter(self.eval_cache))]
+            self.eval_cache[key] = (score_cp, pv)
+            self._eval_cache_new.append((zkey, depth, score_cp, pv))
+        return info
         
     async def cleanup(self):
-        """Закрытие движка"""
-        if self.engine:
+        """Закрытие движков, HTTP-сессии, пула рендера и базы"""
+        if self._render_pool is not None:
+            self._render_pool.shutdown(wait=False, cancel_futures=True)
+            self._render_pool = None
+        if self.http is not None:
+            await self.http.close()
+            self.http = None
+        for eng in self.engine_pool + ([self.grader_engine] if self.grader_engine else []):
             try:
-                await self.engine.quit()
+                await eng.quit()
             except:
                 pass
             # Close transport if stored
-            if hasattr(self.engine, '_transport'):
+            if hasattr(eng, '_transport'):
                 try:
-                    self.engine._transport.close()
+                    eng._transport.close()
                 except:
                     pass
+        self.engine_pool = []
+        self.engine = None
+        self.grader_engine = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
 
     def get_drill_query(self, difficulty: str = "medium", limit: int = 20) -> str:
         """SQL запрос для получения дриллов"""
@@ -530,7 +1104,7 @@ class ChessBot:
         }.get(difficulty, "severity >= 2")
         
         return f"""
-        SELECT drill_id, fen_before, engine_best_san, pv_best, san_played, 
+        SELECT drill_id, fen_before, engine_best_san, pv_best, pv_best_preview, san_played, 
                tags, difficulty, cp_loss, severity, phase
         FROM drills
         WHERE run_id = (SELECT MAX(id) FROM run_meta)
@@ -540,108 +1114,64 @@ class ChessBot:
         LIMIT {limit}
         """
 
-    def fetch_drills(self, difficulty: str = "medium") -> List[Dict]:
+    def get_db_connection(self) -> sqlite3.Connection:
+        """Общее соединение для чтения; open_db (схема, PRAGMA, миграции) — только при первом обращении"""
+        if self._conn is None:
+            self._conn = open_db(DB_PATH)
+        return self._conn
+
+    def fetch_drills(self, difficulty: str = "medium") -> List[sqlite3.Row]:
         """Получение дриллов из базы"""
-        with open_db(DB_PATH) as conn:
-            cursor = conn.execute(self.get_drill_query(difficulty))
-            columns = [desc[0] for desc in cursor.description]
-            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+        return self.get_db_connection().execute(self.get_drill_query(difficulty)).fetchall()
+
+    @staticmethod
+    def _png_key(fen: str, last_move_san: Optional[str], side: str) -> Tuple[str, Optional[str], bool]:
+        # счётчики полуходов/ходов на картинку не влияют
+        return " ".join(fen.split()[:4]), last_move_san, side == "B"
+
+    def _png_cache_get(self, key) -> Optional[bytes]:
+        png = self._png_cache.get(key)
+        if png is not None:
+            self._png_cache.move_to_end(key)
+        return png
+
+    def _png_cache_put(self, key, png: bytes):
+        self._png_cache[key] = png
+        if len(self._png_cache) > BOARD_PNG_CACHE_SIZE:
+            self._png_cache.popitem(last=False)
 
     def render_board_png(self, fen: str, last_move_san: str = None, side: str = "W") -> bytes:
-        """Генерация PNG изображения доски из FEN"""
+        """Генерация PNG изображения доски из FEN (с LRU-кэшем по позиции)"""
+        key = self._png_key(fen, last_move_san, side)
+        png = self._png_cache_get(key)
+        if png is not None:
+            return png
         try:
-            board = chess.Board(fen)
-            
-            # Определяем последний ход если передан
-            last_move = None
-            if last_move_san:
-                try:
-                    # Создаем временную доску для парсинга хода
-                    temp_board = chess.Board(fen)
-                    temp_board.pop()  # Откатываем последний ход
-                    last_move = temp_board.parse_san(last_move_san)
-                except:
-                    pass
-            
-            # Поворачиваем доску если ходят черные
-            flipped = (side == "B")
-            
-            # Генерируем SVG
-            svg_data = chess.svg.board(
-                board, 
-                size=BOARD_SIZE,
-                coordinates=True,
-                flipped=flipped,
-                lastmove=last_move,
-                style="""
-                .square.light { fill: #f0d9b5; }
-                .square.dark { fill: #b58863; }
-                .coord { font-size: 14px; font-family: Arial; }
-                .square.lastmove { fill: rgba(255, 255, 0, 0.4); }
-                """
-            )
-            
-            # Конвертируем SVG в PNG
-            if CAIROSVG_AVAILABLE:
-                png_data = cairosvg.svg2png(bytestring=svg_data.encode('utf-8'))
-                return png_data
-            else:
-                return self._render_simple_board(board, flipped)
-                
+            png = render_board_png_bytes(*key)
         except Exception as e:
             print(f"[ERROR] Board rendering failed: {e}")
             return self._create_error_image()
-
-    def _render_simple_board(self, board: chess.Board, flipped: bool = False) -> bytes:
-        """Простая отрисовка доски без SVG"""
-        if not TELEGRAM_AVAILABLE:
-            return b''
-            
-        img = Image.new('RGB', (BOARD_SIZE, BOARD_SIZE), 'white')
-        draw = ImageDraw.Draw(img)
-        
-        square_size = BOARD_SIZE // 8
-        
-        # Рисуем клетки
-        for rank in range(8):
-            for file in range(8):
-                # Поворачиваем координаты если нужно
-                display_rank = 7 - rank if flipped else rank
-                display_file = 7 - file if flipped else file
-                
-                x1 = display_file * square_size
-                y1 = (7 - display_rank) * square_size
-                x2 = x1 + square_size
-                y2 = y1 + square_size
-                
-                color = '#f0d9b5' if (rank + file) % 2 == 0 else '#b58863'
-                draw.rectangle([x1, y1, x2, y2], fill=color)
-                
-                # Добавляем символы фигур
-                square = chess.square(file, rank)
-                piece = board.piece_at(square)
-                if piece:
-                    piece_char = self._piece_to_unicode(piece)
-                    text_x = x1 + square_size // 2
-                    text_y = y1 + square_size // 2
-                    draw.text((text_x, text_y), piece_char, fill='black', anchor='mm')
-        
-        # Сохраняем в байты
-        buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
-        return buffer.getvalue()
-
-    def _piece_to_unicode(self, piece: chess.Piece) -> str:
-        """Конвертация фигуры в Unicode символ"""
-        symbols = {
-            (chess.KING, chess.WHITE): '♔', (chess.KING, chess.BLACK): '♚',
-            (chess.QUEEN, chess.WHITE): '♕', (chess.QUEEN, chess.BLACK): '♛',
-            (chess.ROOK, chess.WHITE): '♖', (chess.ROOK, chess.BLACK): '♜',
-            (chess.BISHOP, chess.WHITE): '♗', (chess.BISHOP, chess.BLACK): '♝',
-            (chess.KNIGHT, chess.WHITE): '♘', (chess.KNIGHT, chess.BLACK): '♞',
-            (chess.PAWN, chess.WHITE): '♙', (chess.PAWN, chess.BLACK): '♟',
-        }
-        return symbols.get((piece.piece_type, piece.color), '?')
+        self._png_cache_put(key, png)
+        return png
+
+    async def render_board_png_async(self, fen: str, last_move_san: str = None, side: str = "W") -> bytes:
+        """То же, что render_board_png, но промах кэша рендерится в пуле процессов (или в потоке)"""
+        key = self._png_key(fen, last_move_san, side)
+        png = self._png_cache_get(key)
+        if png is not None:
+            return png
+        if self._render_pool is None and RENDER_WORKERS > 0:
+            # spawn: форк процесса с event loop и потоками python-telegram-bot небезопасен
+            self._render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS,
+                                                    mp_context=multiprocessing.get_context("spawn"))
+        try:
+            # без пула (RENDER_WORKERS=0) executor по умолчанию — потоки; кэш трогаем только здесь, в loop
+            png = await asyncio.get_running_loop().run_in_executor(self._render_pool, render_board_png_bytes, *key)
+        except Exception as e:
+            print(f"[ERROR] Board rendering failed: {e}")
+            return self._create_error_image()
+        self._png_cache_put(key, png)
+        return png
 
     def _create_error_image(self) -> bytes:
         """Создание изображения с ошибкой"""
@@ -654,7 +1184,7 @@ class ChessBot:
                  fill='red', anchor='mm')
         
         buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
+        img.save(buffer, format='PNG', compress_level=1, optimize=False)
         return buffer.getvalue()
 
     async def analyze_move(self, fen: str, move_san: str, best_san: str) -> Dict:
@@ -683,21 +1213,19 @@ class ChessBot:
                     "error": f"Некорректный ход: {move_san}"
                 }
             
-            # Анализируем позицию до хода
-            info_before = await self.engine.analyse(board, chess.engine.Limit(depth=15))
-            eval_before = info_before.get("score")
-            
-            # Делаем ход и анализируем после
-            board.push(move)
-            info_after = await self.engine.analyse(board, chess.engine.Limit(depth=15))
-            eval_after = info_after.get("score")
+            async with self._acquire_grader() as eng:
+                # Анализируем позицию до хода
+                info_before = await eng.analyse(board, engine_limit(GRADER_DEPTH))
+                eval_before = cp_from_info(info_before)
+
+                # Делаем ход и анализируем после
+                board.push(move)
+                info_after = await eng.analyse(board, engine_limit(GRADER_DEPTH))
+                eval_after = cp_from_info(info_after)
             
-            if eval_before and eval_after:
-                # Рассчитываем потерю в сантипешках
-                cp_before = eval_before.pov(chess.WHITE).score() or 0
-                cp_after = eval_after.pov(chess.WHITE).score() or 0
-                
-                cp_loss = abs(cp_before - cp_after)
+            if eval_before is not None and eval_after is not None:
+                # Потеря в сантипешках в той же шкале, что cp_loss дриллов
+                cp_loss = min(abs(eval_before - eval_after), CP_LOSS_CAP)
                 
                 if cp_loss <= ACCEPTABLE_CP_LOSS:
                     quality = "good"
@@ -734,54 +1262,59 @@ class ChessBot:
         if not self.engine:
             return {"success": False, "error": "Engine not available"}
         
+        conn = None
         try:
-            # Создаем сессию для API
-            session = make_session(f"chess-personal-trainer (contact: chess-trainer@example.com)")
-            
             # Получаем архивы
             if progress_callback:
                 await progress_callback("📥 Получение списка партий...")
             
-            archives = get_archives(session, username, 5, 1.0)
-            archives = sorted(archives)[-months:]
-            
-            if not archives:
+            pgn_texts = await self._download_archives(username, months, progress_callback)
+            if pgn_texts is None:
                 return {"success": False, "error": f"Нет партий для пользователя {username}"}
             
-            # Загружаем партии
+            conn = open_db(DB_PATH)
+
+            # Уже проанализированные партии — одним запросом; по заголовкам они отсеиваются
+            # до разбора ходов, как и партии не 5+0
+            existing_ids = set() if force_reanalyze else {r[0] for r in conn.execute("SELECT DISTINCT game_id FROM moves")}
+            skipped_games = 0
+
+            def skip_analyzed(headers):
+                nonlocal skipped_games
+                if game_id(headers) in existing_ids:
+                    skipped_games += 1
+                    return True
+                return False
+
+            # Разбор PGN — в потоке, чтобы не блокировать event loop
             games = []
-            for i, archive_url in enumerate(archives):
-                if progress_callback:
-                    await progress_callback(f"📥 Загрузка архива {i+1}/{len(archives)}...")
-                
-                pgn_text = fetch_archive_pgn(session, archive_url, 5, 1.0)
-                archive_games = parse_pgn_games(pgn_text)
-                
-                # Фильтруем 5+0
-                archive_games = [g for g in archive_games if is_5plus0_game(g)]
-                games.extend(archive_games)
+            for pgn_text in pgn_texts:
+                games.extend(await asyncio.to_thread(load_games, pgn_text, True, skip_analyzed))
+            games_total = len(games) + skipped_games
             
-            if not games:
+            if not games_total:
                 return {"success": False, "error": "Нет партий 5+0 за указанный период"}
             
             # Анализируем партии
             if progress_callback:
-                await progress_callback(f"🔍 Анализ {len(games)} партий...")
+                await progress_callback(f"🔍 Анализ {games_total} партий...")
             
-            conn = open_db(DB_PATH)
             engine_name = self.engine.id.get("name", "Stockfish")
             
             # Создаем новый run
+            # одна метка на прогон: ее же получают все дриллы
+            generated_at = datetime.utcnow().isoformat()+"Z"
             cur = conn.cursor()
             cur.execute("""INSERT INTO run_meta(generated_at,user,engine_name,depth,max_positions,from_api,months,only_5plus0)
                            VALUES(?,?,?,?,?,?,?,?)""",
-                        (datetime.utcnow().isoformat()+"Z", username, engine_name, depth,
+                        (generated_at, username, engine_name, depth,
                          max_positions, 1, months, 1))
             run_id = cur.lastrowid
             conn.commit()
             
             # Анализируем с прогрессом
-            await self._analyze_games_async(conn, games, username, run_id, depth, max_positions, progress_callback, force_reanalyze)
+            await self._analyze_games_async(conn, games, username, run_id, depth, max_positions, progress_callback,
+                                            force_reanalyze, skipped_games, created_at=generated_at)
             
             # Статистика
             cur.execute("SELECT COUNT(*) FROM drills WHERE run_id = ?", (run_id,))
@@ -792,175 +1325,183 @@ class ChessBot:
             cur.execute("SELECT COUNT(DISTINCT game_id) FROM moves WHERE run_id = ?", (run_id,))
             new_games_analyzed = cur.fetchone()[0]
             
-            conn.close()
-            
             return {
                 "success": True, 
-                "games_total": len(games),
+                "games_total": games_total,
                 "games_new": new_games_analyzed,
-                "games_skipped": len(games) - new_games_analyzed,
+                "games_skipped": games_total - new_games_analyzed,
                 "drills": drills_count,
                 "run_id": run_id
             }
             
         except Exception as e:
             return {"success": False, "error": f"Ошибка обновления: {str(e)}"}
+        finally:
+            if conn is not None:
+                conn.close()
     
-    async def _analyze_games_async(self, conn, games, username, run_id, depth, max_positions, progress_callback, force_reanalyze: bool = False):
-        """Асинхронный анализ партий с прогрессом"""
+    async def _download_archives(self, username: str, months: int, progress_callback=None) -> Optional[List[str]]:
+        """Параллельная загрузка последних архивов (не больше ARCHIVE_FETCH_CONCURRENCY одновременно).
 
-        cur = conn.cursor()
-        eval_used = 0
-        analyzed_games = 0
-        skipped_games = 0
-        
-        for game_idx, game in enumerate(games):
-            if progress_callback and game_idx % 10 == 0:
-                mode_txt = "принудительно" if force_reanalyze else f"новых: {analyzed_games}, пропущено: {skipped_games}"
-                await progress_callback(f"🔍 Партия {game_idx+1}/{len(games)} ({mode_txt})")
-            
-            white = game.headers.get("White","")
-            black = game.headers.get("Black","")
-            date = game.headers.get("UTCDate", game.headers.get("Date",""))
-            result = game.headers.get("Result","")
-            termination = game.headers.get("Termination","")
-            time_control = game.headers.get("TimeControl","")
-            gid = f"{date}_{white}_vs_{black}".strip("_")
-
-            # Проверяем, была ли эта партия уже проанализирована (если не force)
-            if not force_reanalyze:
-                cur.execute("SELECT COUNT(*) FROM moves WHERE game_id = ?", (gid,))
-                moves_count = cur.fetchone()[0]
-                
-                if moves_count > 0:
-                    # Партия уже анализировалась, пропускаем
-                    skipped_games += 1
-                    cur.execute("""INSERT OR IGNORE INTO games(game_id, date_utc, white, black, time_control, result, termination)
-                                   VALUES(?,?,?,?,?,?,?)""", (gid, date, white, black, time_control, result, termination))
-                    continue
-            
-            analyzed_games += 1
-            
-            # upsert game
-            cur.execute("""INSERT OR IGNORE INTO games(game_id, date_utc, white, black, time_control, result, termination)
-                           VALUES(?,?,?,?,?,?,?)""", (gid, date, white, black, time_control, result, termination))
-
-            board = game.board()
-            node = game
-            ply = 0
-            last_clock = {"W": None, "B": None}
-
-            while node.variations and eval_used < max_positions:
-                next_node = node.variation(0)
-                san = next_node.san()
-                ply += 1
-
-                side = "W" if board.turn == chess.WHITE else "B"
-                phase = phase_from_ply(ply)
-
-                # BEFORE eval
-                if not self.engine:
-                    print(f"[ERROR] Engine not available for analysis at ply {ply}")
-                    break
-                    
-                info_before = await self.engine.analyse(board, chess.engine.Limit(depth=depth))
-                eval_before = cp_from_info(info_before)
+        Архивы берутся в JSON: партии не 5+0 отбрасываются до разбора PGN."""
+        sem = asyncio.Semaphore(ARCHIVE_FETCH_CONCURRENCY)
+        done = 0
 
-                # Записываем FEN ДО хода
-                fen_before = board.fen()
-                
-                # Получаем ход из SAN для текущей позиции
-                try:
-                    move = board.parse_san(san)
-                except ValueError as e:
-                    print(f"[ERROR] Cannot parse SAN '{san}' for position {fen_before}: {e}")
-                    break
-                
-                # timing
-                comment = next_node.comment
-                clk_after = parse_clock(comment)
-                time_spent = None
-                if clk_after is not None and last_clock[side] is not None:
-                    dt = last_clock[side] - clk_after
-                    if dt >= 0: time_spent = dt
-
-                # Делаем ход
-                board.push(move)
-                
-                # Переходим к следующему узлу
-                node = next_node
+        async def report(archives):
+            nonlocal done
+            done += 1
+            if progress_callback:
+                await progress_callback(f"📥 Загружено архивов {done}/{len(archives)}...")
+
+        if AIOHTTP_AVAILABLE:
+            if self.http is None or self.http.closed:
+                self.http = aiohttp.ClientSession(
+                    headers={"User-Agent": USER_AGENT},
+                    connector=aiohttp.TCPConnector(limit_per_host=HTTP_POOL_SIZE))
+            http = self.http
+            archives = sorted(await get_archives_async(http, username, 5, 1.0))[-months:]
+            if not archives:
+                return None
 
-                # AFTER eval
-                info_after = await self.engine.analyse(board, chess.engine.Limit(depth=depth))
-                eval_after = cp_from_info(info_after)
-                eval_used += 2
-
-                # cp loss for mover pov
-                cp_loss = None
-                if eval_before is not None and eval_after is not None:
-                    loss_white_pov = eval_before - eval_after
-                    cp_loss = loss_white_pov if side == "W" else -loss_white_pov
-
-                flags = san_motif_flags(san)
-
-                # update last clock
-                if clk_after is not None:
-                    last_clock[side] = clk_after
-
-                # insert move
-                cur.execute("""INSERT INTO moves(run_id, game_id, ply, side, phase, san, fen_before,
-                                                 clock_after_sec, time_spent_sec, eval_before_cp, eval_after_cp, cp_loss,
-                                                 is_check, is_capture, is_pawn_push, is_promotion, is_castle)
-                               VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-                            (run_id, gid, ply, side, phase, san, fen_before, clk_after, time_spent,
-                             eval_before, eval_after, cp_loss,
-                             flags["is_check"], flags["is_capture"], flags["is_pawn_push"],
-                             flags["is_promotion"], flags["is_castle"]))
-
-                # DRILL candidate?
-                is_blunder = (cp_loss is not None and cp_loss >= BLUNDER_CP)
-                is_long = (time_spent is not None and time_spent > LONG_THINK_SEC)
-
-                if is_blunder or is_long:
-                    engine_best_san = None
-                    pv_best = "[]"
-                    if info_before and "pv" in info_before and info_before["pv"]:
-                        # Создаем доску из FEN до хода для анализа PV
-                        board_for_pv = chess.Board(fen_before)
-                        engine_best_san, pv_best = pv_to_san(board_for_pv, info_before["pv"])
-
-                    # severity ranking
-                    if cp_loss is not None and cp_loss >= SEVERE_BLUNDER_CP:
-                        severity = 3
-                    elif is_blunder and is_long:
-                        severity = 2
-                    elif is_blunder:
-                        severity = 1
-                    else:
-                        severity = 0
-
-                    tags = []
-                    if is_blunder: tags.append("blunder")
-                    if is_long: tags.append("long-think")
-                    if flags["is_check"]: tags.append("check")
-                    if flags["is_capture"]: tags.append("capture")
-                    if flags["is_pawn_push"]: tags.append("pawn-push")
-
-                    # deterministic drill_id
-                    import hashlib
-                    src = f"{gid}|{ply}|{fen_before}|{engine_best_san or ''}"
-                    drill_id = hashlib.sha1(src.encode()).hexdigest()[:16]
-
-                    cur.execute("""INSERT OR REPLACE INTO drills(
-                                      drill_id, run_id, game_id, ply, side, phase, san_played, fen_before,
-                                      time_spent_sec, clock_after_sec, cp_loss, engine_best_san,
-                                      eval_before_cp, eval_after_cp, pv_best, severity, tags, difficulty, created_at)
-                                   VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-                                (drill_id, run_id, gid, ply, side, phase, san, fen_before, time_spent, clk_after,
-                                 cp_loss, engine_best_san, eval_before, eval_after, pv_best, severity,
-                                 ",".join(tags), "easy" if cp_loss and cp_loss<250 else "medium", datetime.utcnow().isoformat()+"Z"))
+            async def bounded_fetch(url):
+                async with sem:
+                    text = await fetch_archive_games_async(http, url, 5, 1.0, only_5plus0=True)
+                await report(archives)
+                return text
 
-        conn.commit()
+            return await asyncio.gather(*[bounded_fetch(u) for u in archives])
+
+        # Без aiohttp: синхронный requests в потоках
+        session = make_session(USER_AGENT)
+        archives = sorted(await asyncio.to_thread(get_archives, session, username, 5, 1.0))[-months:]
+        if not archives:
+            return None
+
+        async def bounded_fetch_sync(url):
+            async with sem:
+                text = await asyncio.to_thread(fetch_archive_games, session, url, 5, 1.0, True)
+            await report(archives)
+            return text
+
+        return await asyncio.gather(*[bounded_fetch_sync(u) for u in archives])
+
+    async def _analyze_games_async(self, conn, games, username, run_id, depth, max_positions, progress_callback,
+                                   force_reanalyze: bool = False, skipped_games: int = 0,
+                                   created_at: Optional[str] = None):
+        """Асинхронный анализ партий с прогрессом: партии идут параллельно по пулу движков"""
+
+        budget = EvalBudget(max_positions)
+        games_rows, moves_rows, drills_rows, fens_rows = [], [], [], []
+        created_at = created_at or datetime.utcnow().isoformat()+"Z"
+
+        self._load_eval_cache(conn)
+
+        # Уже проанализированные партии отсеяны при разборе PGN (см. update_games_async)
+        to_analyze = []
+        for game in games:
+            row = game_row(game.headers)
+            games_rows.append(row)
+            to_analyze.append((row[0], game))
+
+        # games пишем сразу: на них ссылаются moves и drills
+        flush_rows(conn, games_rows, moves_rows, drills_rows, fens_rows)
+        done = 0
+
+        async def analyze_one(gid, game):
+            nonlocal done
+            async with self._acquire_engine() as eng:
+                game_moves, game_drills, game_fens = await self._analyze_game_async(eng, game, gid, run_id,
+                                                                                    depth, budget, created_at)
+            # пачками через executemany, как в тренере; запись синхронная, так что между await не перемешивается
+            moves_rows.extend(game_moves)
+            drills_rows.extend(game_drills)
+            fens_rows.extend(game_fens)
+            if len(moves_rows) >= INSERT_BATCH_ROWS:
+                flush_rows(conn, games_rows, moves_rows, drills_rows, fens_rows)
+            done += 1
+            if progress_callback and done % 10 == 0:
+                mode_txt = "принудительно" if force_reanalyze else f"новых: {done}, пропущено: {skipped_games}"
+                await progress_callback(f"🔍 Партия {done}/{len(to_analyze)} ({mode_txt})")
+
+        # TaskGroup, а не gather: при ошибке одной партии остальные отменяются и не продолжают
+        # занимать движки и писать в соединение, которое update_games_async уже закрывает
+        try:
+            async with asyncio.TaskGroup() as tg:
+                for gid, game in to_analyze:
+                    tg.create_task(analyze_one(gid, game))
+        except ExceptionGroup as eg:
+            raise eg.exceptions[0]
+        flush_rows(conn, games_rows, moves_rows, drills_rows, fens_rows)
+        self._save_eval_cache(conn)
+        refresh_run_stats(conn, run_id)
+
+    async def _analyze_game_async(self, eng, game, gid, run_id, depth, budget: EvalBudget,
+                                  created_at: str) -> Tuple[List[tuple], List[tuple], List[tuple]]:
+        """Анализ одной партии на выделенном движке; возвращает строки (moves, drills, fens).
+
+        Оценка после хода K — это оценка до хода K+1, так что на полуход нужен один вызов движка."""
+        moves_rows, drills_rows, fens_rows = [], [], []
+        board = game.board()
+        ply = 0
+        last_clock = {"W": None, "B": None}
+        info_after = None
+        fen_id = position_key(board)
+
+        for node in game.mainline():
+            if not budget.available():
+                break
+            move = node.move
+            san = board.san(move)
+            ply += 1
+
+            side = "W" if board.turn == chess.WHITE else "B"
+            phase = _PHASE_LUT[ply] if ply < _PHASE_LUT_SIZE else "endgame"
+
+            # BEFORE eval: берем из предыдущего полухода, движок — только на первом
+            info_before = info_after
+            if info_before is None:
+                info_before = await self._analyse_cached(eng, board, fen_id, depth, gid, budget)
+            eval_before = cp_from_info(info_before)
+
+            # FEN ДО хода: в moves — ключ, позиция без счетчиков ходов — в fens
+            fen_before = board.fen()
+            fens_rows.append((fen_id, fen_before.rsplit(" ", 2)[0]))
+            move_fen_id = fen_id
+
+            # timing
+            comment = node.comment
+            clk_after = parse_clock(comment)
+            time_spent = None
+            if clk_after is not None and last_clock[side] is not None:
+                dt = last_clock[side] - clk_after
+                if dt >= 0: time_spent = dt
+
+            # Снимок доски до хода нужен только для PV дрилла — копия дешевле разбора FEN
+            board_before = board.copy(stack=False) if info_before and info_before.get("pv") else None
+
+            # Делаем ход
+            board.push(move)
+
+            # AFTER eval
+            # ключ позиции после хода — он же fen_id следующего полухода
+            fen_id = position_key(board)
+            info_after = await self._analyse_cached(eng, board, fen_id, depth, gid, budget)
+            eval_after = cp_from_info(info_after)
+
+            # cp loss for mover pov
+            cp_loss = None
+            if eval_before is not None and eval_after is not None:
+                cp_loss = mover_cp_loss(eval_before, eval_after, side)
+
+            # update last clock
+            if clk_after is not None:
+                last_clock[side] = clk_after
+
+            record_ply(moves_rows, drills_rows, run_id, gid, ply, side, phase, san, move_fen_id, fen_before,
+                       clk_after, time_spent, eval_before, eval_after, cp_loss,
+                       board_before, info_before["pv"] if board_before is not None else None, created_at)
+
+        return moves_rows, drills_rows, fens_rows
 
 # Глобальный экземпляр бота
 bot = ChessBot()
@@ -1006,22 +1547,22 @@ async def drill_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         board = chess.Board(drill['fen_before'])
         current_side = "W" if board.turn == chess.WHITE else "B"
         
-        png_data = bot.render_board_png(
+        png_data = await bot.render_board_png_async(
             drill['fen_before'], 
-            drill.get('san_played'),  # последний сыгранный ход
+            drill['san_played'],  # последний сыгранный ход
             current_side
         )
         
-        tags = drill.get('tags', '').split(',')
+        tags = drill['tags'].split(',')
         tag_text = ', '.join([f"#{tag}" for tag in tags if tag.strip()])
         
         caption = (
             f"🎯 **Найдите лучший ход!**\n"
             f"⚡ Сложность: {difficulty}\n"
-            f"📊 Фаза: {drill.get('phase', 'unknown')}\n"
+            f"📊 Фаза: {drill['phase']}\n"
             f"🏷 {tag_text}\n\n"
             f"Сыгранный ход: `{drill['san_played']}`\n"
-            f"Потеря: {drill.get('cp_loss', '?')} cp\n\n"
+            f"Потеря: {drill['cp_loss']} cp\n\n"
             f"💡 Отправьте лучший ход в ответ на это сообщение!"
         )
         
@@ -1039,13 +1580,14 @@ async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка ответа пользователя"""
     user_id = update.message.from_user.id
     
-    if user_id not in bot.user_sessions:
+    # get, а не in + []: запись может истечь по TTL между проверкой и чтением
+    drill = bot.user_sessions.get(user_id)
+    if drill is None:
         await update.message.reply_text(
             "❓ Сначала выберите задачу с помощью /start"
         )
         return
     
-    drill = bot.user_sessions[user_id]
     user_move = update.message.text.strip()
     
     analysis = await bot.analyze_move(
@@ -1073,46 +1615,38 @@ async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     emoji = emoji_map.get(quality, "🤔")
     response = f"{emoji} {message}"
     
-    if drill.get('pv_best'):
-        try:
-            pv_moves = json.loads(drill['pv_best'])
-            if len(pv_moves) > 1:
-                response += f"\n\n📋 Вариант: {' '.join(pv_moves[:5])}"
-        except:
-            pass
+    if drill['pv_best_preview']:
+        response += f"\n\n📋 Вариант: {drill['pv_best_preview']}"
     
     keyboard = [[InlineKeyboardButton("Следующая задача", callback_data="drill_medium")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     await update.message.reply_text(response, reply_markup=reply_markup)
-    del bot.user_sessions[user_id]
+    bot.user_sessions.pop(user_id, None)
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /stats"""
     try:
-        with open_db(DB_PATH) as conn:
-            cursor = conn.execute("""
-                SELECT 
-                    COUNT(*) as total_drills,
-                    AVG(cp_loss) as avg_cp_loss,
-                    COUNT(CASE WHEN severity >= 3 THEN 1 END) as severe_blunders,
-                    COUNT(CASE WHEN severity = 2 THEN 1 END) as medium_blunders,
-                    COUNT(CASE WHEN severity = 1 THEN 1 END) as light_blunders
-                FROM drills 
-                WHERE run_id = (SELECT MAX(id) FROM run_meta)
-            """)
-            
-            stats = cursor.fetchone()
-            
-            response = (
-                f"📊 **Статистика дриллов**\n\n"
-                f"🎯 Всего задач: {stats[0]}\n"
-                f"📈 Средняя потеря: {stats[1]:.1f} cp\n\n"
-                f"🔴 Грубые ошибки: {stats[2]}\n"
-                f"🟡 Средние ошибки: {stats[3]}\n"
-                f"🟢 Легкие ошибки: {stats[4]}"
-            )
-            
+        conn = bot.get_db_connection()
+        run_id = conn.execute("SELECT MAX(id) FROM run_meta").fetchone()[0]
+        if run_id is None:
+            await update.message.reply_text("❌ Нет данных: сначала выполните /update")
+            return
+        stats = get_run_stats(conn, run_id)
+        if not stats or not stats[0] or stats[1] is None:
+            # в прогоне нет дриллов: AVG вернул NULL
+            await update.message.reply_text("📊 Нет данных: в последнем прогоне нет задач")
+            return
+        
+        response = (
+            f"📊 **Статистика дриллов**\n\n"
+            f"🎯 Всего задач: {stats[0]}\n"
+            f"📈 Средняя потеря: {stats[1]:.1f} cp\n\n"
+            f"🔴 Грубые ошибки: {stats[2]}\n"
+            f"🟡 Средние ошибки: {stats[3]}\n"
+            f"🟢 Легкие ошибки: {stats[4]}"
+        )
+        
         await update.message.reply_text(response, parse_mode='Markdown')
         
     except Exception as e:
@@ -1233,6 +1767,11 @@ def run_bot(args):
         print("[ERROR] TELEGRAM_BOT_TOKEN not set")
         return
     
+    # run_polling создает цикл через текущую политику — ставим ее до запуска
+    if UVLOOP_AVAILABLE:
+        uvloop.install()
+        print("[INFO] Event loop: uvloop")
+
     print("[INFO] Starting Chess Tactics Telegram Bot...")
     print(f"[INFO] Database: {args.db_path}")
     print(f"[INFO] Stockfish: {args.stockfish}")
@@ -1242,9 +1781,8 @@ def run_bot(args):
     DB_PATH = args.db_path
     STOCKFISH_PATH = args.stockfish
     
-    # Создаем базу если не существует
-    conn = open_db(DB_PATH)
-    conn.close()
+    # Создаем базу если не существует; соединение остается у бота для чтения
+    bot.get_db_connection()
     
     # Инициализируем бота
     app = Application.builder().token(BOT_TOKEN).build()
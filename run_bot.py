@@ -6,8 +6,16 @@
 
 import os
 import sys
+from importlib.util import find_spec
 from pathlib import Path
 
+# python-dotenv понимает кавычки, экранирование и export (опционально)
+try:
+    from dotenv import dotenv_values
+    DOTENV_AVAILABLE = True
+except ImportError:
+    DOTENV_AVAILABLE = False
+
 def load_env_file(filename="bot_config.env"):
     """Загрузка переменных окружения из файла"""
     env_path = Path(__file__).parent / filename
@@ -18,6 +26,10 @@ def load_env_file(filename="bot_config.env"):
         return False
     
     try:
+        if DOTENV_AVAILABLE:
+            os.environ.update({k: v for k, v in dotenv_values(env_path).items() if v is not None})
+            print(f"[INFO] Loaded config from {env_path}")
+            return True
         with open(env_path, 'r') as f:
             for line in f:
                 line = line.strip()
@@ -37,12 +49,8 @@ def check_requirements():
         'telegram', 'chess', 'PIL', 'cairosvg'
     ]
     
-    missing = []
-    for module in required_modules:
-        try:
-            __import__(module)
-        except ImportError:
-            missing.append(module)
+    # find_spec только ищет модуль, не выполняя его импорт (cairosvg тянет весь cairo)
+    missing = [m for m in required_modules if find_spec(m) is None]
     
     if missing:
         print(f"[ERROR] Missing required modules: {', '.join(missing)}")
@@ -9,10 +9,15 @@ Chess Tactics Telegram Bot
 
 import os
 import io
+import re
+import functools
 import sqlite3
 import asyncio
+import contextlib
 import hashlib
-import json
+import random
+import threading
+import time
 from pathlib import Path
 from typing import Optional, Dict, List, Tuple
 from datetime import datetime
@@ -24,146 +29,327 @@ from PIL import Image, ImageDraw, ImageFont
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
 
+# Растеризация SVG: resvg (Rust, быстрее) -> cairosvg -> отрисовка через PIL (все опционально)
+try:
+    import resvg_py
+    RESVG_AVAILABLE = True
+except ImportError:
+    RESVG_AVAILABLE = False
+
+try:
+    import cairosvg
+    CAIROSVG_AVAILABLE = True
+except (ImportError, OSError):
+    # OSError — пакет стоит, но нет системной libcairo: падать на импорте нельзя, есть fallback
+    CAIROSVG_AVAILABLE = False
+
 # Конфигурация
 BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', '')
 STOCKFISH_PATH = os.getenv('STOCKFISH_PATH', '/opt/homebrew/bin/stockfish')
 DB_PATH = os.getenv('CHESS_DB_PATH', './trainer_output.sqlite')
 
 BOARD_SIZE = 400
+BOARD_PNG_CACHE_SIZE = 512  # PNG позиций в памяти, ~8 КБ каждая
+BOARD_SVG_STYLE = """
+        .square.light { fill: #f0d9b5; }
+        .square.dark { fill: #b58863; }
+        .coord { font-size: 14px; font-family: Arial; }
+        """
 ACCEPTABLE_CP_LOSS = 50  # ход считается хорошим, если проигрыш <= 50 cp
 
+# Движки для проверки ответов: по движку на ядро (не больше 4), ответы разных пользователей
+# считаются параллельно; хэш на движок меньше, чтобы пул целиком укладывался в ~512 МБ
+ENGINE_POOL_SIZE = min(os.cpu_count() or 1, 4)
+ENGINE_HASH_MB = 128
+ANALYSIS_DEPTH = 15
+# Грубая ошибка в дрилле видна и на малой глубине
+SHALLOW_DEPTH = 10
+SHALLOW_CP_LOSS = 300
+# Мат в оценке — ±MATE_SCORE_CP, потеря ограничена CP_LOSS_CAP: та же шкала, что у cp_loss дриллов
+MATE_SCORE_CP = 30000
+CP_LOSS_CAP = 2000
+# Оценки ответов (fen, ход) -> cp_loss: одни и те же дриллы решают многие пользователи
+MOVE_CACHE_SIZE = 4096
+
+# Набор дриллов меняется только после нового прогона тренера — список держим минуту
+DRILL_CACHE_TTL_SEC = 60
+
+# Минимальная severity для уровня сложности
+DIFFICULTY_MIN_SEVERITY = {"easy": 1, "medium": 2, "hard": 3}
+# Текст запроса постоянный, параметры связываются — sqlite3 берет готовый statement из своего кэша
+DRILLS_SQL = """
+        SELECT drill_id, fen_before, engine_best_san, pv_best, san_played, 
+               tags, difficulty, cp_loss, severity, phase
+        FROM drills
+        WHERE run_id = (SELECT MAX(id) FROM run_meta)
+          AND severity >= ?
+          AND engine_best_san IS NOT NULL
+        ORDER BY severity DESC, cp_loss DESC
+        LIMIT ?
+        """
+# Агрегаты /stats по последнему прогону
+STATS_SQL = """
+    SELECT 
+        COUNT(*) as total_drills,
+        AVG(cp_loss) as avg_cp_loss,
+        COUNT(CASE WHEN severity >= 3 THEN 1 END) as severe_blunders,
+        COUNT(CASE WHEN severity = 2 THEN 1 END) as medium_blunders,
+        COUNT(CASE WHEN severity = 1 THEN 1 END) as light_blunders
+    FROM drills 
+    WHERE run_id = ?
+"""
+LAST_RUN_SQL = "SELECT MAX(id) FROM run_meta"
+
+@functools.lru_cache(maxsize=BOARD_PNG_CACHE_SIZE)
+def render_board_png_cached(fen: str) -> bytes:
+    """PNG доски по FEN; растеризация SVG дорогая, а дриллы повторяются — кэшируем по FEN.
+    Исключения не кэшируются: их обрабатывает ChessBot.render_board_png"""
+    board = chess.Board(fen)
+    
+    # Генерируем SVG: фигуры вставляются в готовый шаблон доски
+    template = _svg_template()
+    if template is not None:
+        prefix, glyphs = template
+        svg_data = prefix + "".join([glyphs[sq, piece.symbol()] for sq, piece in board.piece_map().items()]) + "</svg>"
+    else:
+        svg_data = _board_svg(board)
+    
+    png_data = _svg_to_png(svg_data)
+    if png_data is None:
+        # Fallback: простая PNG генерация без растеризатора SVG
+        return _render_simple_board(board)
+    return png_data
+
+def _board_svg(board: chess.Board) -> str:
+    return chess.svg.board(board, size=BOARD_SIZE, coordinates=True, style=BOARD_SVG_STYLE)
+
+@functools.lru_cache(maxsize=1)
+def _svg_template() -> Optional[Tuple[str, Dict[Tuple[int, str], str]]]:
+    """Неизменная часть SVG (клетки, координаты, стили, определения всех 12 фигур) и
+    готовые <use> для каждой пары (клетка, фигура) — строятся один раз из вывода chess.svg.
+
+    None, если разметка chess.svg не распознана: тогда рендер идет через chess.svg.board."""
+    all_pieces = chess.Board.empty()
+    for i, symbol in enumerate("KQRBNPkqrbnp"):
+        all_pieces.set_piece_at(i, chess.Piece.from_symbol(symbol))
+    defs = re.search(r"<defs>.*?</defs>", _board_svg(all_pieces), re.S)
+    empty = _board_svg(chess.Board.empty())
+    squares = re.findall(r'<rect x="([\d.]+)" y="([\d.]+)" [^>]*class="square (?:light|dark) ([a-h][1-8])"', empty)
+    if not defs or "<defs />" not in empty or "</svg>" not in empty or len(squares) != 64:
+        print("[WARN] Unexpected chess.svg markup, SVG template disabled")
+        return None
+    
+    # <desc> с текстовой доской не рисуется — в шаблоне его нет
+    prefix = re.sub(r"<desc>.*?</desc>", "", empty, flags=re.S).replace("<defs />", defs.group(0), 1)
+    prefix = prefix[:prefix.rindex("</svg>")]
+    glyphs = {}
+    for x, y, name in squares:
+        square = chess.parse_square(name)
+        for symbol in "KQRBNPkqrbnp":
+            piece = chess.Piece.from_symbol(symbol)
+            href = f"#{chess.COLOR_NAMES[piece.color]}-{chess.piece_name(piece.piece_type)}"
+            glyphs[square, symbol] = f'<use href="{href}" xlink:href="{href}" transform="translate({x}, {y})" />'
+    return prefix, glyphs
+
+def _svg_to_png(svg_data: str) -> Optional[bytes]:
+    """SVG -> PNG первым доступным растеризатором; None, если ни один не сработал"""
+    if RESVG_AVAILABLE:
+        try:
+            return bytes(resvg_py.svg_to_bytes(svg_string=svg_data, width=BOARD_SIZE, height=BOARD_SIZE))
+        except Exception as e:
+            print(f"[WARN] resvg failed, falling back: {e}")
+    if CAIROSVG_AVAILABLE:
+        return cairosvg.svg2png(bytestring=svg_data.encode('utf-8'))
+    return None
+
+@functools.lru_cache(maxsize=1)
+def _empty_board_image() -> Image.Image:
+    """Пустая доска строится один раз: 8x8 пикселей по цвету клетки, растянутые без сглаживания"""
+    light, dark = (240, 217, 181), (181, 136, 99)
+    cells = Image.new('RGB', (8, 8))
+    # строка y картинки — горизонталь 7 - y, как при отрисовке фигур
+    cells.putdata([light if ((7 - y) + x) % 2 == 0 else dark for y in range(8) for x in range(8)])
+    return cells.resize((BOARD_SIZE, BOARD_SIZE), Image.NEAREST)
+
+def _render_simple_board(board: chess.Board) -> bytes:
+    """Простая отрисовка доски без SVG"""
+    img = _empty_board_image().copy()
+    sprites = _piece_sprites()
+    ink = (0, 0, 0)
+    
+    square_size = BOARD_SIZE // 8
+    half = square_size // 2
+    
+    # Добавляем символы фигур (упрощенно): только занятые клетки, а не все 64;
+    # глиф — готовая маска, черный цвет накладывается через нее без FreeType
+    for square, piece in board.piece_map().items():
+        text_x = chess.square_file(square) * square_size + half
+        text_y = (7 - chess.square_rank(square)) * square_size + half
+        img.paste(ink, (text_x - half, text_y - half), sprites[(piece.piece_type - 1) | (piece.color << 3)])
+    
+    # Сохраняем в байты
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+# Символы фигур по индексу (piece_type - 1) | (color << 3): белые — 8..13, черные — 0..5
+_PIECE_UNICODE = ('♟', '♞', '♝', '♜', '♛', '♚', '?', '?',
+                  '♙', '♘', '♗', '♖', '♕', '♔', '?', '?')
+
+@functools.lru_cache(maxsize=1)
+def _piece_sprites() -> tuple:
+    """Маски глифов фигур размером с клетку, в том же порядке, что _PIECE_UNICODE.
+    Рисуются один раз тем же шрифтом и с той же привязкой 'mm', что и draw.text раньше"""
+    square_size = BOARD_SIZE // 8
+    sprites = []
+    for glyph in _PIECE_UNICODE:
+        sprite = Image.new('L', (square_size, square_size), 0)
+        ImageDraw.Draw(sprite).text((square_size // 2, square_size // 2), glyph, fill=255, anchor='mm')
+        sprites.append(sprite)
+    return tuple(sprites)
+
+def cp_from_info(info) -> Optional[int]:
+    """Оценка с точки зрения белых; мат переводится в ±MATE_SCORE_CP, как в тренере"""
+    sc = info.get("score") if info else None
+    if sc is None: return None
+    return sc.pov(chess.WHITE).score(mate_score=MATE_SCORE_CP)
+
+@functools.lru_cache(maxsize=256)
+def _board_from_fen(fen: str) -> chess.Board:
+    """Разобранная позиция дрилла; общий объект — менять только копию"""
+    return chess.Board(fen)
+
+@functools.lru_cache(maxsize=1024)
+def _drill_move(fen: str, san: str) -> Optional[chess.Move]:
+    """Ход из записи дрилла (лучший или сыгранный) как chess.Move, None если не разбирается"""
+    try:
+        return _board_from_fen(fen).parse_san(san.strip())
+    except ValueError:
+        return None
+
 class ChessBot:
     def __init__(self):
-        self.engine = None
+        self.engines: List[chess.engine.Protocol] = []
+        self._engine_queue: Optional[asyncio.Queue] = None
         self.user_sessions = {}  # user_id -> current drill info
+        self._conn: Optional[sqlite3.Connection] = None  # одно соединение на весь процесс
+        # запросы идут из рабочих потоков (asyncio.to_thread) — соединение отдаем по одному
+        self._db_lock = threading.Lock()
+        self._drill_cache: Dict[str, Tuple[float, List[Dict]]] = {}  # difficulty -> (monotonic, drills)
+        self._move_cache: Dict[Tuple[str, str], int] = {}  # (fen, uci) -> cp_loss
+        self._stats: Optional[Tuple[int, tuple]] = None  # (run_id, агрегаты /stats)
         
     async def init_engine(self):
-        """Инициализация Stockfish"""
+        """Инициализация пула Stockfish"""
         if not os.path.exists(STOCKFISH_PATH):
             print(f"[ERROR] Stockfish not found at {STOCKFISH_PATH}")
             return False
         
-        try:
-            self.engine = await chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH)
-            await self.engine.configure({"Threads": 1, "Hash": 64})
-            print(f"[INFO] Stockfish initialized: {self.engine.id}")
-            return True
-        except Exception as e:
-            print(f"[ERROR] Failed to init Stockfish: {e}")
+        async def start_one():
+            try:
+                # асинхронный API: popen_uci возвращает (transport, protocol)
+                _, engine = await chess.engine.popen_uci(STOCKFISH_PATH)
+                await engine.configure({"Threads": 1, "Hash": ENGINE_HASH_MB})
+                return engine
+            except Exception as e:
+                print(f"[ERROR] Failed to init Stockfish: {e}")
+                return None
+        
+        engines = await asyncio.gather(*[start_one() for _ in range(ENGINE_POOL_SIZE)])
+        self.engines = [e for e in engines if e is not None]
+        self._engine_queue = asyncio.Queue()
+        for engine in self.engines:
+            self._engine_queue.put_nowait(engine)
+        if not self.engines:
             return False
+        print(f"[INFO] Stockfish initialized: {self.engines[0].id} x{len(self.engines)}")
+        return True
+    
+    @contextlib.asynccontextmanager
+    async def _acquire_engine(self):
+        """Движок из пула в монопольное пользование: вторая команда отменила бы первую"""
+        engine = await self._engine_queue.get()
+        try:
+            yield engine
+        finally:
+            self._engine_queue.put_nowait(engine)
     
     async def cleanup(self):
-        """Закрытие движка"""
-        if self.engine:
-            await self.engine.quit()
+        """Закрытие движков и базы"""
+        for engine in self.engines:
+            await engine.quit()
+        self.engines = []
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
 
     def get_db_connection(self) -> sqlite3.Connection:
-        """Подключение к базе данных"""
-        if not os.path.exists(DB_PATH):
-            raise FileNotFoundError(f"Database not found: {DB_PATH}")
-        return sqlite3.connect(DB_PATH)
-
-    def get_drill_query(self, difficulty: str = "medium", limit: int = 20) -> str:
-        """SQL запрос для получения дриллов"""
-        severity_filter = {
-            "easy": "severity >= 1",
-            "medium": "severity >= 2", 
-            "hard": "severity >= 3"
-        }.get(difficulty, "severity >= 2")
-        
-        return f"""
-        SELECT drill_id, fen_before, engine_best_san, pv_best, san_played, 
-               tags, difficulty, cp_loss, severity, phase
-        FROM drills
-        WHERE run_id = (SELECT MAX(id) FROM run_meta)
-          AND {severity_filter}
-          AND engine_best_san IS NOT NULL
-        ORDER BY severity DESC, cp_loss DESC
-        LIMIT {limit}
-        """
+        """Общее подключение к базе данных, открывается при первом обращении.
+        Бот только читает: режим журнала и synchronous задает тренер, здесь mode=ro.
+        immutable=1 не ставим — тренер может дописать новый прогон, пока бот работает"""
+        if self._conn is None:
+            if not os.path.exists(DB_PATH):
+                raise FileNotFoundError(f"Database not found: {DB_PATH}")
+            uri = f"{Path(DB_PATH).resolve().as_uri()}?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=128)
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute("PRAGMA cache_size=-20000")
+            conn.execute("PRAGMA mmap_size=268435456")
+            self._conn = conn
+        return self._conn
+
+    def get_drill_query(self, difficulty: str = "medium", limit: int = 20) -> Tuple[str, Tuple[int, int]]:
+        """SQL запрос для получения дриллов и его параметры"""
+        return DRILLS_SQL, (DIFFICULTY_MIN_SEVERITY.get(difficulty, 2), limit)
 
     def fetch_drills(self, difficulty: str = "medium") -> List[Dict]:
-        """Получение дриллов из базы"""
-        with self.get_db_connection() as conn:
-            cursor = conn.execute(self.get_drill_query(difficulty))
+        """Получение дриллов из базы (список кэшируется на DRILL_CACHE_TTL_SEC)"""
+        cached = self._drill_cache.get(difficulty)
+        now = time.monotonic()
+        if cached is not None and now - cached[0] < DRILL_CACHE_TTL_SEC:
+            return cached[1]
+        with self._db_lock:
+            cursor = self.get_db_connection().execute(*self.get_drill_query(difficulty))
             columns = [desc[0] for desc in cursor.description]
-            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+            drills = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        self._drill_cache[difficulty] = (now, drills)
+        return drills
+
+    def fetch_stats(self) -> tuple:
+        """Агрегаты дриллов последнего прогона: всего, средняя потеря, по severity 3/2/1.
+        Пересчитываются только при появлении нового прогона — MAX(id) берется по первичному ключу"""
+        with self._db_lock:
+            conn = self.get_db_connection()
+            run_id = conn.execute(LAST_RUN_SQL).fetchone()[0]
+            if self._stats is None or self._stats[0] != run_id:
+                self._stats = (run_id, conn.execute(STATS_SQL, (run_id,)).fetchone())
+            return self._stats[1]
+
+    async def warm_drills(self):
+        """Заполнение кэша дриллов при старте и пререндер их досок,
+        чтобы первый запрос не ждал ни базу, ни растеризацию"""
+        def warm() -> List[Dict]:
+            # одно соединение — уровни и агрегаты /stats читаем по очереди в одном потоке
+            self.fetch_stats()
+            return [d for difficulty in DIFFICULTY_MIN_SEVERITY for d in self.fetch_drills(difficulty)]
+        try:
+            drills = await asyncio.to_thread(warm)
+        except Exception as e:
+            print(f"[WARN] Drill cache warm-up failed: {e}")
+            return
+        pngs = await asyncio.gather(*[asyncio.to_thread(self.render_board_png, d['fen_before']) for d in drills])
+        for drill, png in zip(drills, pngs):
+            drill['png'] = png
+        print(f"[INFO] Pre-rendered {len(drills)} drill boards")
 
     def render_board_png(self, fen: str) -> bytes:
-        """Генерация PNG изображения доски из FEN"""
+        """Генерация PNG изображения доски из FEN (повторные позиции берутся из кэша)"""
         try:
-            board = chess.Board(fen)
-            
-            # Генерируем SVG
-            svg_data = chess.svg.board(
-                board, 
-                size=BOARD_SIZE,
-                coordinates=True,
-                style="""
-                .square.light { fill: #f0d9b5; }
-                .square.dark { fill: #b58863; }
-                .coord { font-size: 14px; font-family: Arial; }
-                """
-            )
-            
-            # Конвертируем SVG в PNG через cairosvg
-            try:
-                import cairosvg
-                png_data = cairosvg.svg2png(bytestring=svg_data.encode('utf-8'))
-                return png_data
-            except ImportError:
-                # Fallback: простая PNG генерация без cairosvg
-                return self._render_simple_board(board)
-                
+            return render_board_png_cached(fen)
         except Exception as e:
             print(f"[ERROR] Board rendering failed: {e}")
             return self._create_error_image()
 
-    def _render_simple_board(self, board: chess.Board) -> bytes:
-        """Простая отрисовка доски без SVG"""
-        img = Image.new('RGB', (BOARD_SIZE, BOARD_SIZE), 'white')
-        draw = ImageDraw.Draw(img)
-        
-        square_size = BOARD_SIZE // 8
-        
-        # Рисуем клетки
-        for rank in range(8):
-            for file in range(8):
-                x1 = file * square_size
-                y1 = (7-rank) * square_size
-                x2 = x1 + square_size
-                y2 = y1 + square_size
-                
-                color = '#f0d9b5' if (rank + file) % 2 == 0 else '#b58863'
-                draw.rectangle([x1, y1, x2, y2], fill=color)
-                
-                # Добавляем символы фигур (упрощенно)
-                square = chess.square(file, rank)
-                piece = board.piece_at(square)
-                if piece:
-                    piece_char = self._piece_to_unicode(piece)
-                    # Примерная позиция для текста
-                    text_x = x1 + square_size // 2
-                    text_y = y1 + square_size // 2
-                    draw.text((text_x, text_y), piece_char, fill='black', anchor='mm')
-        
-        # Сохраняем в байты
-        buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
-        return buffer.getvalue()
-
-    def _piece_to_unicode(self, piece: chess.Piece) -> str:
-        """Конвертация фигуры в Unicode символ"""
-        symbols = {
-            (chess.KING, chess.WHITE): '♔', (chess.KING, chess.BLACK): '♚',
-            (chess.QUEEN, chess.WHITE): '♕', (chess.QUEEN, chess.BLACK): '♛',
-            (chess.ROOK, chess.WHITE): '♖', (chess.ROOK, chess.BLACK): '♜',
-            (chess.BISHOP, chess.WHITE): '♗', (chess.BISHOP, chess.BLACK): '♝',
-            (chess.KNIGHT, chess.WHITE): '♘', (chess.KNIGHT, chess.BLACK): '♞',
-            (chess.PAWN, chess.WHITE): '♙', (chess.PAWN, chess.BLACK): '♟',
-        }
-        return symbols.get((piece.piece_type, piece.color), '?')
-
     def _create_error_image(self) -> bytes:
         """Создание изображения с ошибкой"""
         img = Image.new('RGB', (BOARD_SIZE, BOARD_SIZE), 'lightgray')
@@ -175,16 +361,29 @@ class ChessBot:
         img.save(buffer, format='PNG')
         return buffer.getvalue()
 
-    async def analyze_move(self, fen: str, move_san: str, best_san: str) -> Dict:
-        """Анализ хода через Stockfish"""
-        if not self.engine:
-            return {"valid": False, "error": "Engine not available"}
-            
+    async def analyze_move(self, fen: str, move_san: str, best_san: str,
+                           drill_cp_loss: Optional[int] = None,
+                           san_played: Optional[str] = None) -> Dict:
+        """Анализ хода через Stockfish.
+
+        Обе оценки идут подряд на одном движке с game=fen: python-chess не шлет ucinewgame
+        между ними, и хэш после первой позиции ускоряет вторую.
+        Совпадение с лучшим ходом и нелегальный ход решаются без движка; повтор хода из партии
+        берет cp_loss из дрилла, уже оцененные ответы — из _move_cache."""
         try:
-            board = chess.Board(fen)
+            board = _board_from_fen(fen)
+            
+            # Проверяем валидность хода: parse_san принимает только легальные ходы
+            try:
+                move = board.parse_san(move_san.strip())
+            except ValueError:
+                return {
+                    "valid": False,
+                    "error": f"Некорректный ход: {move_san}"
+                }
             
-            # Прямое сравнение с лучшим ходом
-            if move_san.strip() == best_san.strip():
+            # Сравнение с лучшим ходом как chess.Move: Nf3 и Ngf3, exd5 и exd5+ — один ход
+            if move == _drill_move(fen, best_san):
                 return {
                     "valid": True,
                     "quality": "best",
@@ -192,48 +391,41 @@ class ChessBot:
                     "cp_loss": 0
                 }
             
-            # Проверяем валидность хода
-            try:
-                move = board.parse_san(move_san)
-            except ValueError:
-                return {
-                    "valid": False,
-                    "error": f"Некорректный ход: {move_san}"
-                }
+            # Повтор ошибки из партии: ее cp_loss уже посчитан при генерации дрилла
+            if san_played and drill_cp_loss is not None and move == _drill_move(fen, san_played):
+                return self._grade_move(move_san, best_san, min(max(drill_cp_loss, 0), CP_LOSS_CAP))
+            
+            key = (fen, move.uci())
+            cp_loss = self._move_cache.get(key)
+            if cp_loss is not None:
+                return self._grade_move(move_san, best_san, cp_loss)
             
-            # Анализируем позицию до хода
-            info_before = await self.engine.analyse(board, chess.engine.Limit(depth=15))
-            eval_before = info_before.get("score")
+            if not self.engines:
+                return {"valid": False, "error": "Engine not available"}
             
-            # Делаем ход и анализируем после
-            board.push(move)
-            info_after = await self.engine.analyse(board, chess.engine.Limit(depth=15))
-            eval_after = info_after.get("score")
+            depth = SHALLOW_DEPTH if (drill_cp_loss or 0) >= SHALLOW_CP_LOSS else ANALYSIS_DEPTH
+            limit = chess.engine.Limit(depth=depth)
             
-            if eval_before and eval_after:
-                # Рассчитываем потерю в сантипешках
-                cp_before = eval_before.pov(chess.WHITE).score() or 0
-                cp_after = eval_after.pov(chess.WHITE).score() or 0
+            async with self._acquire_engine() as engine:
+                # Анализируем позицию до хода
+                info_before = await engine.analyse(board, limit, game=fen)
+                eval_before = cp_from_info(info_before)
                 
+                # Делаем ход на копии (доска из кэша общая) и анализируем после
+                board = board.copy(stack=False)
+                board.push(move)
+                info_after = await engine.analyse(board, limit, game=fen)
+                eval_after = cp_from_info(info_after)
+            
+            if eval_before is not None and eval_after is not None:
                 # Потеря с точки зрения игрока, который ходил
-                cp_loss = abs(cp_before - cp_after)
-                
-                if cp_loss <= ACCEPTABLE_CP_LOSS:
-                    quality = "good"
-                    message = f"Хороший ход! {move_san} (потеря: {cp_loss} cp)"
-                elif cp_loss <= 100:
-                    quality = "acceptable" 
-                    message = f"Неплохо: {move_san} (потеря: {cp_loss} cp)\nЛучше было: {best_san}"
-                else:
-                    quality = "poor"
-                    message = f"Не лучший выбор: {move_san} (потеря: {cp_loss} cp)\nЛучший ход: {best_san}"
+                cp_loss = min(abs(eval_before - eval_after), CP_LOSS_CAP)
                 
-                return {
-                    "valid": True,
-                    "quality": quality,
-                    "message": message,
-                    "cp_loss": cp_loss
-                }
+                if len(self._move_cache) >= MOVE_CACHE_SIZE:
+                    # вытесняем самую старую запись (dict хранит порядок вставки)
+                    del self._move_cache[next(iter(self._move_cache))]
+                self._move_cache[key] = cp_loss
+                return self._grade_move(move_san, best_san, cp_loss)
             
             return {
                 "valid": True,
@@ -248,6 +440,35 @@ class ChessBot:
                 "error": f"Ошибка анализа: {str(e)}"
             }
 
+    @staticmethod
+    def _grade_move(move_san: str, best_san: str, cp_loss: int) -> Dict:
+        """Оценка ответа по потере в сантипешках"""
+        if cp_loss <= ACCEPTABLE_CP_LOSS:
+            quality = "good"
+            message = f"Хороший ход! {move_san} (потеря: {cp_loss} cp)"
+        elif cp_loss <= 100:
+            quality = "acceptable" 
+            message = f"Неплохо: {move_san} (потеря: {cp_loss} cp)\nЛучше было: {best_san}"
+        else:
+            quality = "poor"
+            message = f"Не лучший выбор: {move_san} (потеря: {cp_loss} cp)\nЛучший ход: {best_san}"
+        
+        return {
+            "valid": True,
+            "quality": quality,
+            "message": message,
+            "cp_loss": cp_loss
+        }
+
+
+def pv_preview(pv_best: Optional[str], max_moves: int = 5) -> Optional[str]:
+    """Первые ходы варианта из pv_best без json.loads.
+
+    Тренер пишет pv_best через json.dumps: ["e4", "e5", ...]. В SAN и "uci:..." нет кавычек
+    и обратных слешей, так что хватает ограниченного split по разделителю."""
+    if not pv_best or not pv_best.startswith('["') or '", "' not in pv_best:
+        return None  # пусто или один ход — вариант не показываем
+    return ' '.join(pv_best[2:-2].split('", "', max_moves)[:max_moves])
 
 # Инициализация бота
 bot = ChessBot()
@@ -278,21 +499,23 @@ async def drill_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     difficulty = query.data.split('_')[1]  # drill_easy -> easy
     
     try:
-        drills = bot.fetch_drills(difficulty)
+        # SQLite и растеризация блокируют — уводим их с event loop в поток
+        drills = await asyncio.to_thread(bot.fetch_drills, difficulty)
         if not drills:
             await query.message.reply_text(f"❌ Не найдено задач уровня '{difficulty}'")
             return
         
         # Выбираем случайный дрилл
-        import random
         drill = random.choice(drills)
         
         # Сохраняем в сессию пользователя
         user_id = query.from_user.id
         bot.user_sessions[user_id] = drill
         
-        # Генерируем изображение доски
-        png_data = bot.render_board_png(drill['fen_before'])
+        # Доска пререндерена при старте; после обновления кэша дриллов рендерим заново
+        png_data = drill.get('png')
+        if png_data is None:
+            png_data = await asyncio.to_thread(bot.render_board_png, drill['fen_before'])
         
         # Формируем описание
         tags = drill.get('tags', '').split(',')
@@ -308,8 +531,9 @@ async def drill_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"💡 Отправьте лучший ход в ответ на это сообщение!"
         )
         
+        # Telegram принимает bytes напрямую — без обертки в BytesIO
         await query.message.reply_photo(
-            photo=io.BytesIO(png_data),
+            photo=png_data,
             caption=caption,
             parse_mode='Markdown'
         )
@@ -320,7 +544,7 @@ async def drill_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка ответа пользователя"""
-    user_id = update.from_user.id
+    user_id = update.effective_user.id
     
     if user_id not in bot.user_sessions:
         await update.message.reply_text(
@@ -335,7 +559,9 @@ async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     analysis = await bot.analyze_move(
         drill['fen_before'], 
         user_move, 
-        drill['engine_best_san']
+        drill['engine_best_san'],
+        drill.get('cp_loss'),
+        drill.get('san_played')
     )
     
     if not analysis["valid"]:
@@ -360,13 +586,9 @@ async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     response = f"{emoji} {message}"
     
     # Добавляем PV если есть
-    if drill.get('pv_best'):
-        try:
-            pv_moves = json.loads(drill['pv_best'])
-            if len(pv_moves) > 1:
-                response += f"\n\n📋 Вариант: {' '.join(pv_moves[:5])}"
-        except:
-            pass
+    pv_text = pv_preview(drill.get('pv_best'))
+    if pv_text:
+        response += f"\n\n📋 Вариант: {pv_text}"
     
     # Кнопка для новой задачи
     keyboard = [[InlineKeyboardButton("Следующая задача", callback_data="drill_medium")]]
@@ -380,29 +602,21 @@ async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /stats - статистика по дриллам"""
     try:
-        with bot.get_db_connection() as conn:
-            cursor = conn.execute("""
-                SELECT 
-                    COUNT(*) as total_drills,
-                    AVG(cp_loss) as avg_cp_loss,
-                    COUNT(CASE WHEN severity >= 3 THEN 1 END) as severe_blunders,
-                    COUNT(CASE WHEN severity = 2 THEN 1 END) as medium_blunders,
-                    COUNT(CASE WHEN severity = 1 THEN 1 END) as light_blunders
-                FROM drills 
-                WHERE run_id = (SELECT MAX(id) FROM run_meta)
-            """)
-            
-            stats = cursor.fetchone()
-            
-            response = (
-                f"📊 **Статистика дриллов**\n\n"
-                f"🎯 Всего задач: {stats[0]}\n"
-                f"📈 Средняя потеря: {stats[1]:.1f} cp\n\n"
-                f"🔴 Грубые ошибки: {stats[2]}\n"
-                f"🟡 Средние ошибки: {stats[3]}\n"
-                f"🟢 Легкие ошибки: {stats[4]}"
-            )
-            
+        stats = await asyncio.to_thread(bot.fetch_stats)
+        if not stats or not stats[0] or stats[1] is None:
+            # прогонов нет или в последнем нет дриллов: AVG вернул NULL
+            await update.message.reply_text("📊 Нет данных: в последнем прогоне нет задач")
+            return
+        
+        response = (
+            f"📊 **Статистика дриллов**\n\n"
+            f"🎯 Всего задач: {stats[0]}\n"
+            f"📈 Средняя потеря: {stats[1]:.1f} cp\n\n"
+            f"🔴 Грубые ошибки: {stats[2]}\n"
+            f"🟡 Средние ошибки: {stats[3]}\n"
+            f"🟢 Легкие ошибки: {stats[4]}"
+        )
+        
         await update.message.reply_text(response, parse_mode='Markdown')
         
     except Exception as e:
@@ -455,12 +669,16 @@ def main():
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_answer))
     
     # Инициализация и запуск
-    async def startup():
-        await bot.init_engine()
+    async def startup(application):
+        await asyncio.gather(bot.init_engine(), bot.warm_drills())
         
-    async def shutdown():
+    async def shutdown(application):
         await bot.cleanup()
     
+    # без регистрации хуков движки не запускались бы вовсе
+    app.post_init = startup
+    app.post_shutdown = shutdown
+    
     app.run_polling(
         allowed_updates=Update.ALL_TYPES,
         drop_pending_updates=True